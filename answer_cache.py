@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Optional
+
+from spacy.tokens.doc import Doc
+
+# Stop words that change what's being asked. "Who founded" and "when was it founded", "is it" and "is it not",
+# or "the president" and "the first president" need their own entries.
+QUESTION_WORDS = {"who", "whom", "whose", "what", "which", "when", "where", "why", "how", "many", "much"}
+NEGATION_WORDS = {"not", "n't", "no", "never", "nor"}
+ORDER_WORDS = {"first", "third", "last", "next", "former", "formerly", "latter", "before", "after", "afterwards",
+               "since", "until", "during", "top", "bottom", "most", "least", "more", "less", "few", "only"}
+NUMBER_WORDS = {"one", "two", "three", "four", "five", "six", "eight", "nine", "ten", "eleven", "twelve", "fifteen",
+                "twenty", "forty", "fifty", "sixty", "hundred"}
+KEPT_STOP_WORDS = QUESTION_WORDS | NEGATION_WORDS | ORDER_WORDS | NUMBER_WORDS
+
+
+def normalize_question(question_doc: Doc, boolean_question: bool = False) -> Optional[str]:
+    # "Who is the president?" and "who's president" should land on the same entry, yes/no questions shouldn't
+    # share entries with the wh- question made of the same words though
+    # Questions made entirely of stop words would all collide with each other
+    if all(token.is_stop or token.is_punct for token in question_doc):
+        return None
+
+    lemmas = [token.lemma_.lower() for token in question_doc
+              if not token.is_punct and (not token.is_stop or token.lower_ in KEPT_STOP_WORDS or
+                                         token.dep_ == "neg")]
+
+    return ("bool:" if boolean_question else "wh:") + " ".join(lemmas)
+
+
+class AnswerCache:
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.revision: Optional[Hashable] = None
+        self.answers: Dict[str, str] = OrderedDict()
+        # The daemon's background refresh changes the revision from another thread
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def set_revision(self, revision: Hashable) -> None:
+        # Answers are only good for the page revision they were computed from
+        with self.lock:
+            if revision != self.revision:
+                self.answers.clear()
+                self.revision = revision
+
+    def clear(self) -> None:
+        with self.lock:
+            self.answers.clear()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            answer = self.answers.get(key)
+
+            if answer is not None:
+                self.answers.move_to_end(key)
+                self.hits += 1
+
+            return answer
+
+    def record_miss(self) -> None:
+        self.misses += 1
+
+    def put(self, keys: Iterable[str], answer: str, revision: Hashable) -> None:
+        with self.lock:
+            # Answered from a revision that's already been swapped out, don't let it outlive it
+            if revision != self.revision:
+                return
+
+            for key in keys:
+                self.answers[key] = answer
+                self.answers.move_to_end(key)
+
+            while len(self.answers) > self.max_size:
+                self.answers.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self.answers),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
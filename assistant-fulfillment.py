@@ -1,11 +1,14 @@
-from multiprocessing import Pipe, Process
 from flask import Flask, request, make_response, jsonify
-from wiki_daemon import run_daemon
+from daemon_pool import DaemonPool, get_pool_size
+from service_metrics import render_metrics
 import atexit
 
 # initialize the flask app
 app = Flask(__name__)
 
+# Pool of wiki daemon processes, each one answers one question at a time
+daemon_pool: DaemonPool = None
+
 
 # default route
 @app.route('/')
@@ -21,8 +24,7 @@ def results():
     # fetch action from json
     human_question = req.get('queryResult').get('queryText')
 
-    qa_parent_conn.send(human_question)
-    answer = qa_parent_conn.recv()
+    answer = daemon_pool.ask(human_question)
 
     # return a fulfillment response
     return {'fulfillmentText': answer}
@@ -35,18 +37,23 @@ def webhook():
     return make_response(jsonify(results()))
 
 
-def close_wiki_daemon(pipe, process):
-    pipe.close()
-    print("Waiting for child process to end")
-    process.join()
+# Counters and latency histograms from every daemon, in Prometheus text format
+@app.route('/metrics')
+def metrics():
+    response = make_response(render_metrics(daemon_pool.collect_metrics()))
+    response.mimetype = "text/plain"
+    return response
+
+
+def close_wiki_daemons(pool):
+    pool.close()
 
 
 # run the app
 if __name__ == '__main__':
-    qa_parent_conn, qa_child_conn = Pipe()
-    wiki_daemon = Process(target=run_daemon, args=(qa_child_conn,))
-    wiki_daemon.start()
+    daemon_pool = DaemonPool(get_pool_size())
+    daemon_pool.start()
 
-    atexit.register(close_wiki_daemon, qa_parent_conn, wiki_daemon)
+    atexit.register(close_wiki_daemons, daemon_pool)
 
-    app.run()
+    app.run(threaded=True)
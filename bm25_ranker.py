@@ -0,0 +1,65 @@
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from spacy.tokens.doc import Doc
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def bm25_terms(doc: Doc) -> List[str]:
+    # Same words the bags of words hold, minus punctuation and whitespace, counted instead of deduplicated
+    return [token.text.lower() for token in doc if not (token.is_stop or token.is_punct or token.is_space)]
+
+
+class BM25Index:
+
+    def __init__(self, body_docs: Dict[str, List[Doc]], k1: float = BM25_K1, b: float = BM25_B):
+        # Rows are paragraphs in document order, same as the topic matrix
+        self.rows: List[Tuple[str, int]] = []
+        self.term_columns: Dict[str, int] = {}
+        rows, columns, counts = [], [], []
+
+        for header, paragraphs in body_docs.items():
+            for i, paragraph in enumerate(paragraphs):
+                row = len(self.rows)
+                self.rows.append((header, i))
+
+                term_counts: Dict[str, int] = {}
+                for term in bm25_terms(paragraph):
+                    term_counts[term] = term_counts.get(term, 0) + 1
+
+                for term, count in term_counts.items():
+                    rows.append(row)
+                    columns.append(self.term_columns.setdefault(term, len(self.term_columns)))
+                    counts.append(count)
+
+        term_frequencies = csr_matrix((np.array(counts, dtype=np.float64), (rows, columns)),
+                                      shape=(len(self.rows), len(self.term_columns)))
+
+        # Everything but the query is fixed per revision, so the whole BM25 weight of each (paragraph, term) pair
+        # gets worked out here and scoring a question is a single sparse matrix-vector product
+        paragraph_count = len(self.rows)
+        document_frequencies = np.bincount(term_frequencies.indices, minlength=len(self.term_columns))
+        idf = np.log((paragraph_count - document_frequencies + 0.5) / (document_frequencies + 0.5) + 1)
+
+        lengths = np.asarray(term_frequencies.sum(axis=1)).ravel()
+        average_length = lengths.mean() if paragraph_count > 0 and lengths.mean() > 0 else 1.0
+        row_norms = k1 * (1 - b + b * lengths / average_length)
+
+        weights = term_frequencies.copy()
+        row_of_entry = np.repeat(np.arange(paragraph_count), np.diff(weights.indptr))
+        weights.data = idf[weights.indices] * weights.data * (k1 + 1) / (weights.data + row_norms[row_of_entry])
+
+        self.weights = weights
+
+    def score(self, terms: Iterable[str]) -> np.ndarray:
+        query = np.zeros(len(self.term_columns))
+
+        for term in set(terms):
+            column = self.term_columns.get(term)
+            if column is not None:
+                query[column] = 1
+
+        return self.weights @ query
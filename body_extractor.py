@@ -1,17 +1,52 @@
 import sys
-from typing import Dict, List, Set
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 import re
 import spacy
-from spacy.tokens import Doc
+from spacy.tokens import Doc, Span
 from wikiextractor.clean import clean_markup
 
+# Sentence boundaries get computed once when a paragraph is loaded so answers can be mapped back to a sentence
+# with a bisect. Only ints are stored so the docs can still be serialized.
+if not Doc.has_extension("sent_char_starts"):
+    Doc.set_extension("sent_char_starts", default=None)
+if not Doc.has_extension("sent_token_bounds"):
+    Doc.set_extension("sent_token_bounds", default=None)
 
-def wikitext_paragraphs_by_title(wiki_text: str) -> Dict[str, List[str]]:
-    paragraphs = {}
+# What spaCy calls the spacy_wordnet component once it's added to a pipeline
+WORDNET_PIPE = "spacy_wordnet"
+
+
+def index_sentences(doc: Doc) -> Doc:
+    sentences = list(doc.sents)
+    doc._.sent_char_starts = [sent.start_char for sent in sentences]
+    doc._.sent_token_bounds = [(sent.start, sent.end) for sent in sentences]
+
+    return doc
+
+
+def sentence_from_char_idx(doc: Doc, char_idx: int) -> Optional[Span]:
+    if doc._.sent_char_starts is None:
+        index_sentences(doc)
+
+    if not 0 <= char_idx < len(doc.text):
+        return None
+
+    start, end = doc._.sent_token_bounds[bisect_right(doc._.sent_char_starts, char_idx) - 1]
 
+    return doc[start:end]
+
+
+def wikitext_paragraphs_by_title(wiki_text: str) -> Dict[str, List[str]]:
     with open(wiki_text, 'r') as f:
         markup = f.read()
 
+    return markup_paragraphs_by_title(markup)
+
+
+def markup_paragraphs_by_title(markup: str) -> Dict[str, List[str]]:
+    paragraphs = {}
+
     clean_lines = clean_markup(markup, ignore_headers=False)
 
     header = "Introduction."
@@ -25,14 +60,30 @@ def wikitext_paragraphs_by_title(wiki_text: str) -> Dict[str, List[str]]:
     return paragraphs
 
 
-def wikitext_docs_by_title(wiki_text: str, nlp: spacy.Language) -> Dict[str, List[Doc]]:
-    docs = {}
-    paragraphs = wikitext_paragraphs_by_title(wiki_text)
+def parse_texts(texts: Iterable[str], nlp: spacy.Language, batch_size: int = 64, n_process: int = 1) -> List[Doc]:
+    # nlp.pipe hands docs back in the same order the texts went in
+    if n_process == 1 or WORDNET_PIPE not in nlp.pipe_names:
+        return list(nlp.pipe(texts, batch_size=batch_size, n_process=n_process))
+
+    # spacy_wordnet's token annotations live in the doc's user data, which doesn't survive the trip back from the
+    # other processes. Parse over there without it and annotate here.
+    wordnet = nlp.get_pipe(WORDNET_PIPE)
+    return [wordnet(doc) for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process,
+                                              disable=[WORDNET_PIPE])]
+
 
-    for section, section_paragraphs in paragraphs.items():
-        docs[section] = list(map(lambda p: nlp(p), section_paragraphs))
+def paragraph_docs_by_title(paragraphs: Dict[str, List[str]], nlp: spacy.Language, batch_size: int = 64,
+                            n_process: int = 1) -> Dict[str, List[Doc]]:
+    docs = iter(parse_texts((p for section_paragraphs in paragraphs.values() for p in section_paragraphs), nlp,
+                            batch_size, n_process))
 
-    return docs
+    return {section: [index_sentences(next(docs)) for _ in section_paragraphs]
+            for section, section_paragraphs in paragraphs.items()}
+
+
+def wikitext_docs_by_title(wiki_text: str, nlp: spacy.Language, batch_size: int = 64,
+                           n_process: int = 1) -> Dict[str, List[Doc]]:
+    return paragraph_docs_by_title(wikitext_paragraphs_by_title(wiki_text), nlp, batch_size, n_process)
 
 
 def wikitext_bag_by_title(wiki_docs: Dict[str, List[Doc]]) -> Dict[str, List[Set[str]]]:
@@ -45,5 +96,51 @@ def wikitext_bag_by_title(wiki_docs: Dict[str, List[Doc]]) -> Dict[str, List[Set
 
     return bags
 
+
+def sentence_bags(doc: Doc) -> List[Set[str]]:
+    # Same words as the paragraph bags, one bag per sentence
+    if doc._.sent_token_bounds is None:
+        index_sentences(doc)
+
+    return [set(token.text.lower() for token in doc[start:end] if not token.is_stop)
+            for start, end in doc._.sent_token_bounds]
+
+
+def wikitext_bag_index(bags: Dict[str, List[Set[str]]]) -> Dict[str, List[Tuple[str, int]]]:
+    # term -> every (header, paragraph index) whose bag holds it, in document order
+    index: Dict[str, List[Tuple[str, int]]] = {}
+
+    for header, paragraph_bags in bags.items():
+        for i, paragraph_bag in enumerate(paragraph_bags):
+            for term in paragraph_bag:
+                index.setdefault(term, []).append((header, i))
+
+    return index
+
+
+def patch_bag_index(index: Dict[str, List[Tuple[str, int]]], old_bags: Dict[str, List[Set[str]]],
+                    new_bags: Dict[str, List[Set[str]]], headers: Set[str]) -> Dict[str, List[Tuple[str, int]]]:
+    # Returns a patched copy so whoever is still reading the old index isn't disturbed. Posting lists for terms that
+    # no changed section uses are shared with the old index.
+    index = dict(index)
+    new_postings = wikitext_bag_index({header: new_bags[header] for header in headers if header in new_bags})
+
+    touched_terms = set(new_postings)
+    for header in headers:
+        for bag in old_bags.get(header, []):
+            touched_terms |= bag
+
+    for term in touched_terms:
+        postings = [posting for posting in index.get(term, []) if posting[0] not in headers]
+        postings += new_postings.get(term, [])
+
+        if len(postings) > 0:
+            index[term] = postings
+        else:
+            index.pop(term, None)
+
+    return index
+
+
 if __name__ == "__main__":
     print(wikitext_docs_by_title(sys.argv[1], spacy.load("en_core_web_sm")))
@@ -0,0 +1,316 @@
+import itertools
+import os
+import threading
+import time
+from multiprocessing import Pipe, get_context
+from multiprocessing.process import BaseProcess
+from multiprocessing.connection import Connection, wait
+from typing import Any, Dict, List, Optional
+
+from service_metrics import METRICS, MetricsRegistry, merge_metrics
+from wiki_daemon import prepare_page_files, refresh_page_files, run_daemon, INQUIRY_MESSAGE, METRICS_MESSAGE, \
+    NO_ANSWER, RELOAD_MESSAGE, UPDATE_PERIOD_SECS
+
+# Each worker holds its own spaCy pipeline and transformer, so don't go overboard on the count
+DEFAULT_POOL_SIZE = max(1, (os.cpu_count() or 1) // 2)
+METRICS_TIMEOUT_SECS = 5
+# Between a worker dying and its replacement starting, so one that can't even start up doesn't spin
+RESPAWN_DELAY_SECS = 5
+# How often a receiver thread looks up from the pipe to see if the pool is closing
+RECEIVE_POLL_SECS = 1
+# How long a web request waits on its worker before giving up with NO_ANSWER
+ASK_TIMEOUT_SECS = 30
+# Downloading and building every page from scratch, past this the builder is stopped and workers load what's on disk.
+# A builder stuck on the network or a lock gets stopped the same way, so the next refresh can still run.
+BUILD_TIMEOUT_SECS = 1800
+
+
+class PendingAnswer:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.answer: Any = None
+
+    def resolve(self, answer: Any) -> None:
+        self.answer = answer
+        self.event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        self.event.wait(timeout)
+        return self.answer
+
+
+class DaemonWorker:
+
+    def __init__(self, worker_id: int, qa_threads: Optional[int] = None):
+        self.worker_id = worker_id
+        self.qa_threads = qa_threads
+        # All made in start(), again every time the worker gets replaced
+        self.parent_conn: Optional[Connection] = None
+        self.process: Optional[BaseProcess] = None
+        self.receiver: Optional[threading.Thread] = None
+        self.closing = False
+
+        # Requests that have been sent to this worker and haven't been answered yet, keyed by request id
+        self.pending: Dict[int, PendingAnswer] = {}
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
+    def start(self) -> None:
+        # Spawned rather than forked, replacements get started from the receiver thread while the web app has other
+        # threads going. Other workers don't get a copy of this pipe either, so when this worker dies nobody else
+        # holds its end.
+        parent_conn, child_conn = Pipe()
+        process = get_context("spawn").Process(target=run_daemon, args=(child_conn, self.qa_threads),
+                                                daemon=True)
+        process.start()
+
+        # The worker has its own copy now. Ours would keep the pipe open after the worker is gone.
+        child_conn.close()
+
+        with self.send_lock:
+            self.parent_conn = parent_conn
+            self.process = process
+
+        self.receiver = threading.Thread(target=self.receive_answers, args=(parent_conn, process), daemon=True)
+        self.receiver.start()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def load(self) -> int:
+        with self.pending_lock:
+            return len(self.pending)
+
+    def submit(self, request_id: int, payload: Optional[str], kind: str = INQUIRY_MESSAGE) -> PendingAnswer:
+        pending = PendingAnswer()
+
+        with self.pending_lock:
+            self.pending[request_id] = pending
+
+        # Only one thread can write to the pipe at a time, otherwise the messages could interleave
+        with self.send_lock:
+            self.parent_conn.send((request_id, kind, payload, time.time()))
+
+        return pending
+
+    def forget(self, request_id: int) -> None:
+        with self.pending_lock:
+            self.pending.pop(request_id, None)
+
+    def receive_answers(self, parent_conn: Connection, process: BaseProcess) -> None:
+        while not self.closing:
+            # A worker that gets killed doesn't always leave the pipe at EOF, its sentinel tells us either way.
+            # Closing the pipe from another thread doesn't wake this up, so it checks back every so often.
+            ready = wait([parent_conn, process.sentinel], RECEIVE_POLL_SECS)
+            if len(ready) == 0:
+                continue
+            if parent_conn not in ready:
+                break
+
+            try:
+                request_id, answer = parent_conn.recv()
+            except (EOFError, OSError):
+                break
+
+            with self.pending_lock:
+                pending = self.pending.pop(request_id, None)
+
+            if pending is not None:
+                pending.resolve(answer)
+
+        # Worker is gone or being closed. Closing our end first means anything sent from here on fails in submit()
+        # instead of waiting on an answer that won't come, then nobody already waiting gets left hanging. The worker
+        # sees EOF and exits.
+        with self.send_lock:
+            parent_conn.close()
+
+        with self.pending_lock:
+            orphaned = list(self.pending.values())
+            self.pending.clear()
+
+        for pending in orphaned:
+            pending.resolve(NO_ANSWER)
+
+        process.join()
+        if self.closing:
+            return
+
+        print(f"daemon_pool: Worker {self.worker_id} exited with {process.exitcode}, starting a new one")
+        time.sleep(RESPAWN_DELAY_SECS)
+        if not self.closing:
+            self.start()
+
+    def close(self) -> None:
+        self.closing = True
+
+        # The receiver closes the pipe on its way out. One that was in the middle of replacing the worker leaves a
+        # new receiver behind, which stops straight away.
+        receiver = None
+        while self.receiver is not receiver:
+            receiver = self.receiver
+            receiver.join()
+
+        if self.process is not None:
+            self.process.join()
+
+
+class DaemonPool:
+
+    def __init__(self, size: int = DEFAULT_POOL_SIZE):
+        # The cores get split between the workers instead of every worker's torch trying to use all of them
+        qa_threads = max(1, (os.cpu_count() or 1) // size)
+        self.workers: List[DaemonWorker] = [DaemonWorker(i, qa_threads) for i in range(size)]
+        self.request_ids = itertools.count()
+        self.request_id_lock = threading.Lock()
+
+        # Checks Wikipedia for every worker, so pages only get downloaded and built once
+        self.refresh_thread = threading.Thread(target=self.refresh_pages, daemon=True)
+        self.stop_refresh = threading.Event()
+        # What every builder run so far recorded, the builder process takes its own METRICS with it when it exits
+        self.builder_metrics = MetricsRegistry()
+
+    def start(self) -> None:
+        # Only one process downloads pages and writes snapshots, the workers just load them
+        if not self.build_pages(prepare_page_files):
+            print("daemon_pool: Page build didn't finish, workers will load whatever is on disk")
+
+        for worker in self.workers:
+            worker.start()
+
+        self.refresh_thread.start()
+
+    def refresh_pages(self) -> None:
+        while not self.stop_refresh.wait(UPDATE_PERIOD_SECS):
+            # Builds in its own process so it doesn't fight the web app for the GIL
+            if not self.build_pages(refresh_page_files):
+                print("daemon_pool: Page refresh didn't finish, trying again next period")
+
+            # Workers only swap in what's actually new on disk, so they all get told either way. Nobody waits on the
+            # replies, the receiver threads drop them.
+            for worker in self.workers:
+                if worker.is_alive():
+                    request_id = self.next_request_id()
+                    try:
+                        worker.submit(request_id, None, RELOAD_MESSAGE)
+                    except OSError:
+                        # Died since we checked, its replacement loads what's on disk when it starts anyway
+                        worker.forget(request_id)
+
+    def build_pages(self, target) -> bool:
+        build_start = time.perf_counter()
+        registry = run_page_builder(target)
+        METRICS.observe("polyvoice_page_build_seconds", time.perf_counter() - build_start,
+                        {"target": target.__name__, "finished": str(registry is not None).lower()})
+
+        if registry is None:
+            return False
+
+        # Builds run one at a time, collect_metrics only ever sees the reference being swapped
+        self.builder_metrics = merge_metrics([self.builder_metrics, registry])
+        return True
+
+    def least_loaded_worker(self) -> DaemonWorker:
+        live_workers = [worker for worker in self.workers if worker.is_alive()]
+
+        if len(live_workers) == 0:
+            live_workers = self.workers
+
+        return min(live_workers, key=lambda worker: worker.load())
+
+    def next_request_id(self) -> int:
+        with self.request_id_lock:
+            return next(self.request_ids)
+
+    def ask(self, question: str, timeout: Optional[float] = ASK_TIMEOUT_SECS) -> str:
+        request_id = self.next_request_id()
+        ask_start = time.perf_counter()
+
+        worker = self.least_loaded_worker()
+        try:
+            answer = worker.submit(request_id, question).wait(timeout)
+        except OSError:
+            # Worker died after we picked it, its receiver thread starts a new one
+            worker.forget(request_id)
+            METRICS.inc("polyvoice_ask_failures_total")
+            return NO_ANSWER
+        METRICS.observe("polyvoice_ask_seconds", time.perf_counter() - ask_start)
+
+        if answer is None:
+            # Timed out, the worker's reply (if it ever comes) has nobody to go to
+            worker.forget(request_id)
+            METRICS.inc("polyvoice_ask_timeouts_total")
+            return NO_ANSWER
+
+        return answer
+
+    def collect_metrics(self, timeout: float = METRICS_TIMEOUT_SECS) -> MetricsRegistry:
+        # Every live worker sends back a copy of its metrics, they get added up with the web app's own
+        requests = []
+        for worker in self.workers:
+            if worker.is_alive():
+                request_id = self.next_request_id()
+                try:
+                    requests.append((worker, request_id, worker.submit(request_id, None, METRICS_MESSAGE)))
+                except OSError:
+                    worker.forget(request_id)
+
+        registries = [METRICS.snapshot(), self.builder_metrics]
+        for worker, request_id, pending in requests:
+            registry = pending.wait(timeout)
+
+            if isinstance(registry, MetricsRegistry):
+                registries.append(registry)
+            else:
+                # Busy past the timeout or gone, report what we have
+                worker.forget(request_id)
+
+        return merge_metrics(registries)
+
+    def close(self) -> None:
+        self.stop_refresh.set()
+
+        print("Waiting for child processes to end")
+        for worker in self.workers:
+            worker.close()
+
+
+def build_and_report(target, metrics_conn: Connection) -> None:
+    # Runs in the builder process. Its download and build timings would go with it, so they're sent back first.
+    target()
+    metrics_conn.send(METRICS.snapshot())
+    metrics_conn.close()
+
+
+def run_page_builder(target, timeout: float = BUILD_TIMEOUT_SECS) -> Optional[MetricsRegistry]:
+    # The builder's metrics once it's done, None if it failed or ran out of time.
+    # Spawned rather than forked, so the builder doesn't start out with a copy of a lock another thread of ours held.
+    context = get_context("spawn")
+    metrics_conn, child_conn = context.Pipe(duplex=False)
+    builder = context.Process(target=build_and_report, args=(target, child_conn))
+    builder.start()
+    child_conn.close()
+
+    # Read before joining, a builder with more metrics than fit in the pipe can't exit until they're read. EOF
+    # instead means it exited without sending any.
+    registry = None
+    finished = metrics_conn.poll(timeout)
+    if finished:
+        try:
+            registry = metrics_conn.recv()
+        except EOFError:
+            pass
+    metrics_conn.close()
+
+    if not finished:
+        builder.terminate()
+    builder.join()
+
+    return registry
+
+
+def get_pool_size() -> int:
+    try:
+        return max(1, int(os.environ.get("POLYVOICE_WORKERS", DEFAULT_POOL_SIZE)))
+    except ValueError:
+        return DEFAULT_POOL_SIZE
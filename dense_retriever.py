@@ -0,0 +1,66 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from spacy import Language
+from spacy.tokens.doc import Doc
+
+
+def has_word_vectors(nlp: Language) -> bool:
+    # The sm models ship without a vectors table, doc.vector falls back to averaging the tok2vec tensor there
+    return len(nlp.vocab.vectors) > 0
+
+
+def normalized_vector(doc: Doc) -> np.ndarray:
+    # Unit length, so a dot product is the cosine similarity. Docs with no vector stay all zeros and never match.
+    vector = np.asarray(doc.vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+
+    return vector / norm if norm > 0 else vector
+
+
+def paragraph_vectors_by_title(wiki_docs: Dict[str, List[Doc]]) -> Dict[str, np.ndarray]:
+    # Averaged word vectors, so only meaningful when has_word_vectors holds for the pipeline that parsed the docs
+    return {header: np.array([normalized_vector(paragraph) for paragraph in paragraphs], dtype=np.float32)
+            for header, paragraphs in wiki_docs.items()}
+
+
+def stack_paragraph_vectors(vectors: Dict[str, Optional[np.ndarray]]) -> Optional[np.ndarray]:
+    # One row per paragraph in document order, the same rows as the topic matrix
+    if len(vectors) == 0 or any(section_vectors is None for section_vectors in vectors.values()):
+        return None
+
+    sections = [section_vectors for section_vectors in vectors.values() if len(section_vectors) > 0]
+    if len(sections) == 0:
+        return None
+
+    return np.vstack(sections)
+
+
+def save_vectors(matrix: np.ndarray, vectors_file: str) -> None:
+    # Other knowledge may still have the old file mapped, so write a new file and swap it in instead of truncating
+    scratch_file = f"{vectors_file}.{os.getpid()}.npy"
+    np.save(scratch_file, np.asarray(matrix, dtype=np.float32))
+    os.replace(scratch_file, vectors_file)
+
+
+def load_vectors(vectors_file: str) -> Optional[np.ndarray]:
+    # Memory mapped, so every daemon worker reads the same pages of the file instead of holding its own copy
+    try:
+        return np.load(vectors_file, mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def top_k_rows(matrix: np.ndarray, query_vector: np.ndarray, k: int) -> List[Tuple[float, int]]:
+    scores = matrix @ query_vector
+
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+
+    # Best first, ties in document order
+    candidates = sorted(candidates, key=lambda row: (-scores[row], row))
+
+    return [(float(scores[row]), int(row)) for row in candidates if scores[row] > 0]
@@ -0,0 +1,105 @@
+import bz2
+import sys
+import time
+from typing import Iterator, List, Optional
+from xml.etree import ElementTree
+
+from hypernym_cache import HYPERNYM_CACHE
+from page_knowledge import save_snapshot, snapshot_dir_for
+from wiki_daemon import WikiDaemon, WIKI_PAGES
+from wiki_fetcher import PageRevision
+
+# Ingested pages get added to revisions.json this many at a time, it's rewritten whole on every write
+MANIFEST_BATCH_SIZE = 100
+
+
+class DumpPage:
+
+    def __init__(self, title: str, revision_id: int, timestamp: str, wikitext: str):
+        self.title = title
+        self.revision_id = revision_id
+        self.timestamp = timestamp
+        self.wikitext = wikitext
+
+
+def dump_title(title: str) -> str:
+    # Dumps spell titles the way the page shows them, we spell them the way the URL does
+    return title.replace("_", " ")
+
+
+def iter_dump_pages(dump_file: str, titles: Optional[List[str]] = None) -> Iterator[DumpPage]:
+    # title in the dump -> title as we asked for it. None means take every article.
+    wanted = None if titles is None else {dump_title(title): title for title in titles}
+
+    opener = bz2.open if dump_file.endswith(".bz2") else open
+    with opener(dump_file, 'rb') as f:
+        context = ElementTree.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+
+        # Every tag in an export carries the schema's namespace, e.g. {http://www.mediawiki.org/xml/export-0.10/}
+        namespace = root.tag[:root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+
+        for event, element in context:
+            if event != "end" or element.tag != f"{namespace}page":
+                continue
+
+            title = element.findtext(f"{namespace}title")
+            revision = element.find(f"{namespace}revision")
+            is_article = element.findtext(f"{namespace}ns") == "0" and element.find(f"{namespace}redirect") is None
+
+            if is_article and revision is not None and (wanted is None or title in wanted):
+                wikitext = revision.findtext(f"{namespace}text")
+
+                if wikitext is not None:
+                    yield DumpPage(title if wanted is None else wanted.pop(title),
+                                   int(revision.findtext(f"{namespace}id")),
+                                   revision.findtext(f"{namespace}timestamp"),
+                                   wikitext)
+
+            # Finished pages are dropped right away, so memory stays at about one page no matter the dump size
+            root.clear()
+
+            if wanted is not None and len(wanted) == 0:
+                return
+
+    if wanted is not None and len(wanted) > 0:
+        print(f"dump_ingester: Not in the dump (or only as redirects): {', '.join(wanted.values())}")
+
+
+def ingest_dump(dump_file: str, wiki_pages: List[str] = WIKI_PAGES) -> None:
+    wiki_daemon = WikiDaemon(wiki_pages, load_transformer=False)
+    # Pages whose files and snapshot are written but that aren't in the manifest yet
+    ingested: List[PageRevision] = []
+
+    try:
+        for dump_page in iter_dump_pages(dump_file, wiki_pages):
+            page = wiki_daemon.pages[dump_page.title]
+
+            build_start = time.time()
+            # Same files and manifest entry an API download leaves, so the daemon picks these up like any other
+            # revision
+            page.store_wiki_page({"revid": dump_page.revision_id, "html": None, "wikitext": dump_page.wikitext})
+
+            # Knowledge goes straight to a snapshot instead of being held, so thousands of pages fit in memory too
+            knowledge = page.build_knowledge(str(dump_page.revision_id), wikitext=dump_page.wikitext)
+            save_snapshot(knowledge, snapshot_dir_for(dump_page.title), wiki_daemon.spacy_model)
+            print(f"Ingested revision {dump_page.revision_id} of {dump_page.title} in "
+                  f"{time.time() - build_start} seconds")
+
+            ingested.append(PageRevision(dump_page.title, dump_page.revision_id, dump_page.timestamp))
+            if len(ingested) >= MANIFEST_BATCH_SIZE:
+                wiki_daemon.manifest.record_all(ingested)
+                ingested = []
+    finally:
+        # Whatever made it to disk gets recorded, even if a later page fails
+        if len(ingested) > 0:
+            wiki_daemon.manifest.record_all(ingested)
+        HYPERNYM_CACHE.save()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: dump_ingester.py <pages-articles.xml[.bz2]> [title ...]")
+        sys.exit(1)
+
+    ingest_dump(sys.argv[1], sys.argv[2:] if len(sys.argv) > 2 else WIKI_PAGES)
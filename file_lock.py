@@ -0,0 +1,14 @@
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(lock_file: str, shared: bool = False):
+    # flock goes with the open file, so threads of one process wait on each other the same as separate processes do.
+    # The kernel lets go of it when a process dies, a killed builder can't leave it held.
+    with open(lock_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from nltk.corpus import wordnet as wn
+from nltk.corpus.reader import Synset
+
+HYPERNYM_CACHE_SIZE = 50000
+HYPERNYM_CACHE_FILE = "wordnet_hypernyms.json"
+
+
+class HypernymEntry:
+
+    def __init__(self, hypernyms: Tuple[Synset, ...], max_depth: int):
+        self.hypernyms = hypernyms
+        self.max_depth = max_depth
+        # ancestor -> (number of hypernym paths reaching it, shortest distance), including the synset itself
+        self.closure: Optional[Dict[Synset, Tuple[int, int]]] = None
+
+
+class HypernymCache:
+
+    def __init__(self, max_size: int = HYPERNYM_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries: Dict[Synset, HypernymEntry] = OrderedDict()
+        self.lock = threading.RLock()
+
+    def entry(self, synset: Synset) -> HypernymEntry:
+        with self.lock:
+            entry = self.entries.get(synset)
+
+            if entry is None:
+                entry = HypernymEntry(tuple(synset.hypernyms()), synset.max_depth())
+                self.entries[synset] = entry
+
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            else:
+                self.entries.move_to_end(synset)
+
+            return entry
+
+    def hypernyms(self, synset: Synset) -> Tuple[Synset, ...]:
+        return self.entry(synset).hypernyms
+
+    def max_depth(self, synset: Synset) -> int:
+        return self.entry(synset).max_depth
+
+    def closure(self, synset: Synset) -> Dict[Synset, Tuple[int, int]]:
+        entry = self.entry(synset)
+
+        if entry.closure is None:
+            closure = {synset: (1, 0)}
+
+            for parent in entry.hypernyms:
+                for ancestor, (paths, distance) in self.closure(parent).items():
+                    old_paths, old_distance = closure.get(ancestor, (0, distance + 1))
+                    closure[ancestor] = (old_paths + paths, min(old_distance, distance + 1))
+
+            entry.closure = closure
+
+        return entry.closure
+
+    def save(self, cache_file: str = HYPERNYM_CACHE_FILE) -> None:
+        with self.lock:
+            entries = list(self.entries.items())
+
+        # Synsets are stored by name, the reader object behind them doesn't need to go to disk
+        serialized = {}
+        for synset, entry in entries:
+            serialized[synset.name()] = {
+                "hypernyms": [parent.name() for parent in entry.hypernyms],
+                "max_depth": entry.max_depth,
+                "closure": None if entry.closure is None else
+                {ancestor.name(): [paths, distance] for ancestor, (paths, distance) in entry.closure.items()}
+            }
+
+        # Several daemon workers may save at once, so write to a scratch file and swap it in
+        scratch_file = f"{cache_file}.{os.getpid()}"
+        with open(scratch_file, 'w') as f:
+            json.dump(serialized, f)
+
+        os.replace(scratch_file, cache_file)
+
+    def load(self, cache_file: str = HYPERNYM_CACHE_FILE) -> bool:
+        try:
+            with open(cache_file, 'r') as f:
+                serialized = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        with self.lock:
+            for name, fields in serialized.items():
+                entry = HypernymEntry(tuple(wn.synset(parent) for parent in fields["hypernyms"]), fields["max_depth"])
+
+                if fields["closure"] is not None:
+                    entry.closure = {wn.synset(ancestor): (paths, distance)
+                                     for ancestor, (paths, distance) in fields["closure"].items()}
+
+                self.entries[wn.synset(name)] = entry
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+        return True
+
+
+# Shared by get_topic_dict and the daemon's question scoring, so each synset's tree only gets walked once a process
+HYPERNYM_CACHE = HypernymCache()
@@ -3,6 +3,7 @@ import sys
 from typing import Dict, List
 import re
 import spacy
+import wikitextparser as wtp
 from spacy import Language
 from spacy.tokens import Doc, Span
 from wikiextractor.clean import clean_markup
@@ -21,12 +22,26 @@ INFOBOX_SECTION_TRANSFORMS = {
 }
 
 
-def wikitext_infobox_clean(infobox_file: str) -> Dict[str, str]:
-    clean_infobox = {}
+def wikitext_infobox_fields(wikitext: str) -> Dict[str, str]:
+    # Same field -> raw value dict wptools gives back, without another parse request to get it
+    for template in wtp.parse(wikitext).templates:
+        if template.name.strip().lower().startswith("infobox"):
+            return {argument.name.strip(): argument.value.strip() for argument in template.arguments
+                    if argument.value.strip() != ""}
+
+    return {}
 
+
+def wikitext_infobox_clean(infobox_file: str) -> Dict[str, str]:
     with open(infobox_file, 'r') as f:
         infobox = json.load(f)
 
+    return infobox_fields_clean(infobox)
+
+
+def infobox_fields_clean(infobox: Dict[str, str]) -> Dict[str, str]:
+    clean_infobox = {}
+
     for key, value in infobox.items():
         if INFOBOX_BLACKLIST.search(key) is None:
             clean_value = list(clean_markup(value))
@@ -38,15 +53,13 @@ def wikitext_infobox_clean(infobox_file: str) -> Dict[str, str]:
     return clean_infobox
 
 
-def wikitext_infobox_docs(infobox_file: str, nlp: Language) -> Dict[str, Doc]:
-    infobox_docs = {}
-
+def wikitext_infobox_docs(infobox_file: str, nlp: Language, batch_size: int = 64, n_process: int = 1) \
+        -> Dict[str, Doc]:
     infobox_strings = wikitext_infobox_clean(infobox_file)
 
-    for section, value in infobox_strings.items():
-        infobox_docs[section] = nlp(value)
+    docs = nlp.pipe(infobox_strings.values(), batch_size=batch_size, n_process=n_process)
 
-    return infobox_docs
+    return dict(zip(infobox_strings.keys(), docs))
 
 
 def wikitext_infobox_numbers(infobox_docs: Dict[Doc, Doc]) -> Dict[Doc, Span]:
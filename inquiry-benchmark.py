@@ -0,0 +1,114 @@
+import json
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from inquiry_trace import InquiryTrace, INQUIRY_STAGES
+from wiki_daemon import WikiDaemon, WIKI_PAGES
+
+QUESTIONS_FILE = "benchmark_questions.jsonl"
+RESULTS_FILE = "benchmark_results.json"
+# Every question goes through the cascade this many times, so the percentiles have something to work with
+BENCHMARK_REPEATS = 3
+PERCENTILES = (50, 95, 99)
+
+
+def load_questions(questions_file: str) -> List[Dict[str, str]]:
+    # One {"question_id": ..., "question": ...} object per line, blank lines are skipped
+    with open(questions_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    # Milliseconds, rounded so runs on the same commit diff cleanly apart from real changes
+    summary = {"count": len(samples)}
+
+    if len(samples) > 0:
+        for percentile, value in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+            summary[f"p{percentile}_ms"] = round(float(value) * 1000, 3)
+        summary["mean_ms"] = round(float(np.mean(samples)) * 1000, 3)
+
+    return summary
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_benchmark(questions_file: str = QUESTIONS_FILE, results_file: str = RESULTS_FILE,
+                  repeats: int = BENCHMARK_REPEATS) -> Dict:
+    questions = load_questions(questions_file)
+
+    wiki_daemon = WikiDaemon(WIKI_PAGES)
+    wiki_daemon.reload_spacy_docs()
+
+    # First call pays for lazy loading in spaCy, WordNet and the transformer, keep it out of the numbers
+    wiki_daemon.inquiry(questions[0]["question"])
+
+    stage_samples: Dict[str, List[float]] = {stage: [] for stage in INQUIRY_STAGES}
+    total_samples: List[float] = []
+    answered_by: Dict[str, int] = {}
+    question_results = []
+
+    for question in questions:
+        totals = []
+
+        for _ in range(repeats):
+            # Cached answers would only measure the cache, every run should go through the whole cascade
+            wiki_daemon.answer_cache.clear()
+
+            trace = InquiryTrace()
+            inquiry_start = time.perf_counter()
+            answer = wiki_daemon.inquiry(question["question"], trace)
+            totals.append(time.perf_counter() - inquiry_start)
+
+            for stage, seconds in trace.timings.items():
+                stage_samples[stage].append(seconds)
+            answered_by[trace.answered_by] = answered_by.get(trace.answered_by, 0) + 1
+
+        total_samples += totals
+        question_results.append({
+            "question_id": question.get("question_id"),
+            "question": question["question"],
+            "answer": answer,
+            "answered_by": trace.answered_by,
+            "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in trace.timings.items()},
+            "total": latency_summary(totals)
+        })
+
+    results = {
+        "commit": get_commit(),
+        "questions_file": questions_file,
+        "repeats": repeats,
+        "total": latency_summary(total_samples),
+        "stages": {stage: latency_summary(samples) for stage, samples in stage_samples.items()},
+        "answered_by": answered_by,
+        # With the QA cascade on, how often the small model had to hand off to the full one
+        "qa_stats": wiki_daemon.transformer.stats(),
+        "questions": question_results
+    }
+
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+    print(f"{'stage':<14}{'count':>7}" + "".join(f"{f'p{percentile} ms':>12}" for percentile in PERCENTILES))
+    for stage in INQUIRY_STAGES + ("total",):
+        summary = results["total"] if stage == "total" else results["stages"][stage]
+        print(f"{stage:<14}{summary['count']:>7}" +
+              "".join(f"{summary.get(f'p{percentile}_ms', 0):>12.3f}" for percentile in PERCENTILES))
+    print(f"Answered by: {answered_by}")
+    print(f"QA model: {results['qa_stats']}")
+    print(f"Wrote {results_file}")
+
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else QUESTIONS_FILE,
+                  sys.argv[2] if len(sys.argv) > 2 else RESULTS_FILE)
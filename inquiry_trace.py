@@ -0,0 +1,35 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Stages of WikiDaemon.inquiry, in the order the cascade reaches them
+INQUIRY_STAGES = ("preprocess", "cache", "parse", "list", "infobox_qa", "dense_rank", "synset_rank", "bag_fallback",
+                  "transformer", "sentence")
+
+
+class InquiryTrace:
+
+    def __init__(self):
+        # stage -> seconds spent in it for this question, only stages the question actually reached show up
+        self.timings: Dict[str, float] = {}
+        # Stage whose result became the answer, "none" when the cascade gave up
+        self.answered_by: Optional[str] = None
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Stages like sentence resolution run once per candidate, so their time adds up
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def merge(self, other: 'InquiryTrace') -> None:
+        # Stages run on another thread keep their own trace, and only get added in if their result was used
+        for name, seconds in other.timings.items():
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def answer(self, stage: str, answer: str) -> str:
+        self.answered_by = stage
+
+        return answer
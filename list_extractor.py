@@ -12,7 +12,12 @@ nlp = spacy.load("en_core_web_sm")
 def get_wikitext_lists(wikitext_file):
     with open(wikitext_file, 'r') as in_file:
         text = in_file.read()
-        parsed = wtp.parse(text)
+
+    return get_markup_lists(text)
+
+
+def get_markup_lists(text):
+    parsed = wtp.parse(text)
 
     lists = {}
     sections = parsed.sections
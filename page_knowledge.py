@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from nltk.corpus import wordnet as wn
+from nltk.corpus.reader import Synset
+from spacy import Language
+from spacy.tokens import DocBin
+from spacy.tokens.doc import Doc
+from spacy.tokens.span import Span
+
+from bm25_ranker import BM25Index
+from body_extractor import wikitext_bag_index, index_sentences, patch_bag_index, sentence_bags
+from dense_retriever import load_vectors, save_vectors, stack_paragraph_vectors
+from file_lock import file_lock
+from infobox_extractor import wikitext_infobox_numbers
+from paragraph_categorizer import get_topic_matrix
+
+# Bump this whenever the layout of the snapshot files changes so old snapshots get rebuilt instead of misread
+SNAPSHOT_FORMAT_VERSION = 3
+SNAPSHOT_MANIFEST = "manifest.json"
+SNAPSHOT_DOCS = "docs.spacy"
+SNAPSHOT_KNOWLEDGE = "knowledge.json"
+SNAPSHOT_VECTORS = "vectors.npy"
+
+
+class PageKnowledge:
+
+    def __init__(self, revision: Optional[str] = None):
+        # Everything here is derived from one revision of the page
+        self.revision = revision
+
+        self.body_docs: Dict[str, List[Doc]] = {}
+        self.body_topics: Dict[str, List[Dict[Synset, int]]] = {}
+        self.body_bags_of_words: Dict[str, List[Set[str]]] = {}
+        self.lists: Dict[str, Tuple[str, ...]] = {}
+        # header -> one unit length vector per paragraph, for the dense retriever
+        self.body_vectors: Dict[str, Optional[np.ndarray]] = {}
+
+        # header -> hash of the section's cleaned paragraphs, used to tell which sections a new revision touched
+        self.section_hashes: Dict[str, str] = {}
+
+        self.infobox: Dict[str, Doc] = {}
+        self.infobox_paragraph: Optional[str] = None
+        self.infobox_doc: Optional[Doc] = None
+
+        # Lookup structures, rebuilt from the fields above by build_indexes
+        self.topic_matrix = None
+        self.topic_columns: Dict[Synset, int] = {}
+        self.topic_rows: List[Tuple[str, int]] = []
+        self.body_bag_index: Dict[str, List[Tuple[str, int]]] = {}
+        self.infobox_numbers: Dict[str, Span] = {}
+        # body_vectors stacked, rows line up with topic_rows. Memory mapped when loaded from a snapshot.
+        self.paragraph_vectors: Optional[np.ndarray] = None
+        self.bm25_index: Optional[BM25Index] = None
+        # id of a body paragraph or infobox doc -> its QA tokenizer encoding. Filled in by the daemon that serves
+        # this knowledge, since only it has the QA model.
+        self.context_encodings: Dict[int, object] = {}
+        # id of a body paragraph or infobox doc -> one bag of words per sentence, for narrowing QA contexts
+        self.sentence_bags: Dict[int, List[Set[str]]] = {}
+
+    def build_indexes(self, previous: Optional['PageKnowledge'] = None) -> None:
+        # The matrix is rebuilt from the (mostly carried over) topic dicts, that's cheap next to spaCy and WordNet
+        self.topic_matrix, self.topic_columns, self.topic_rows = get_topic_matrix(self.body_topics)
+
+        if previous is None or len(previous.body_bags_of_words) == 0:
+            self.body_bag_index = wikitext_bag_index(self.body_bags_of_words)
+        else:
+            # Only the postings for sections whose bags changed (or that went away) get touched
+            changed_headers = {header for header in set(self.body_bags_of_words) | set(previous.body_bags_of_words)
+                               if self.body_bags_of_words.get(header) is not previous.body_bags_of_words.get(header)}
+            self.body_bag_index = patch_bag_index(previous.body_bag_index, previous.body_bags_of_words,
+                                                  self.body_bags_of_words, changed_headers)
+
+        self.infobox_numbers = wikitext_infobox_numbers(self.infobox)
+
+        # Only token counts go into it, so it's rebuilt from the docs rather than stored in the snapshot
+        self.bm25_index = BM25Index(self.body_docs)
+
+        docs = [doc for paragraphs in self.body_docs.values() for doc in paragraphs]
+        if self.infobox_doc is not None:
+            docs.append(self.infobox_doc)
+        self.sentence_bags = {id(doc): sentence_bags(doc) for doc in docs}
+
+        if self.paragraph_vectors is None:
+            self.paragraph_vectors = stack_paragraph_vectors(self.body_vectors)
+
+
+class CorpusKnowledge:
+
+    def __init__(self, pages: Dict[str, PageKnowledge]):
+        # Page title -> that page's knowledge, in corpus order
+        self.pages = pages
+        self.revision = tuple((title, knowledge.revision) for title, knowledge in pages.items())
+
+        # Routing tables so retrieval only visits pages that share a term or synset with the question
+        self.term_pages: Dict[str, List[str]] = {}
+        self.synset_pages: Dict[Synset, List[str]] = {}
+        # Every page's QA context encodings, so a paragraph's can be found without knowing its page
+        self.context_encodings: Dict[int, object] = {}
+        self.sentence_bags: Dict[int, List[Set[str]]] = {}
+
+        for title, knowledge in pages.items():
+            self.context_encodings.update(knowledge.context_encodings)
+            self.sentence_bags.update(knowledge.sentence_bags)
+
+            for term in knowledge.body_bag_index:
+                self.term_pages.setdefault(term, []).append(title)
+            for synset in knowledge.topic_columns:
+                self.synset_pages.setdefault(synset, []).append(title)
+
+    def ordered(self, titles: Iterable[str]) -> List[str]:
+        titles = set(titles)
+
+        return [title for title in self.pages if title in titles]
+
+
+def section_hash(paragraphs: List[str]) -> str:
+    return hashlib.sha1("\n".join(paragraphs).encode('utf-8')).hexdigest()
+
+
+def snapshot_dir_for(wiki_page: str) -> str:
+    return f"{wiki_page}.snapshot"
+
+
+def snapshot_lock_file(snapshot_dir: str) -> str:
+    # Next to the directory rather than in it, so it's there to lock before the directory is
+    return f"{snapshot_dir}.lock"
+
+
+def save_snapshot(knowledge: PageKnowledge, snapshot_dir: str, spacy_model: str) -> None:
+    # Nobody reads the files while they're being rewritten, and two writers take turns instead of mixing their files
+    with file_lock(snapshot_lock_file(snapshot_dir)):
+        write_snapshot(knowledge, snapshot_dir, spacy_model)
+
+
+def write_snapshot(knowledge: PageKnowledge, snapshot_dir: str, spacy_model: str) -> None:
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    # The manifest goes last, so a snapshot a crashed writer left half written never looks valid
+    manifest_file = os.path.join(snapshot_dir, SNAPSHOT_MANIFEST)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+
+    # spacy_wordnet's token annotations can't be serialized. They're only needed to build the topic dicts, and
+    # those are stored on their own below.
+    doc_bin = DocBin(store_user_data=False)
+    for paragraphs in knowledge.body_docs.values():
+        for doc in paragraphs:
+            doc_bin.add(doc)
+    for doc in knowledge.infobox.values():
+        doc_bin.add(doc)
+    if knowledge.infobox_doc is not None:
+        doc_bin.add(knowledge.infobox_doc)
+
+    doc_bin.to_disk(os.path.join(snapshot_dir, SNAPSHOT_DOCS))
+
+    vectors_file = os.path.join(snapshot_dir, SNAPSHOT_VECTORS)
+    if knowledge.paragraph_vectors is not None:
+        save_vectors(knowledge.paragraph_vectors, vectors_file)
+    elif os.path.exists(vectors_file):
+        os.remove(vectors_file)
+
+    compiled = {
+        "body_layout": {header: len(paragraphs) for header, paragraphs in knowledge.body_docs.items()},
+        "infobox_sections": list(knowledge.infobox.keys()),
+        "infobox_paragraph": knowledge.infobox_paragraph,
+        "topics": {header: [{synset.name(): count for synset, count in topic_dict.items()}
+                            for topic_dict in paragraphs_topics]
+                   for header, paragraphs_topics in knowledge.body_topics.items()},
+        "bags": {header: [sorted(bag) for bag in paragraph_bags]
+                 for header, paragraph_bags in knowledge.body_bags_of_words.items()},
+        "lists": {title: list(items) for title, items in knowledge.lists.items()}
+    }
+
+    with open(os.path.join(snapshot_dir, SNAPSHOT_KNOWLEDGE), 'w') as f:
+        json.dump(compiled, f)
+
+    with open(manifest_file, 'w') as f:
+        json.dump({
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "revision": knowledge.revision,
+            "spacy_model": spacy_model
+        }, f)
+
+
+def load_snapshot_manifest(snapshot_dir: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def snapshot_matches(manifest: Optional[Dict], spacy_model: str, revision: str) -> bool:
+    # Anything built for a different revision, model or layout has to be rebuilt
+    return manifest is not None and manifest.get("format_version") == SNAPSHOT_FORMAT_VERSION and \
+        manifest.get("spacy_model") == spacy_model and manifest.get("revision") == revision
+
+
+def load_snapshot(snapshot_dir: str, nlp: Language, spacy_model: str, revision: str) -> Optional[PageKnowledge]:
+    # Every file gets read under the lock so they all come from the same save. The vectors stay mapped after, that's
+    # safe since save_vectors swaps in a new file instead of rewriting the old one.
+    with file_lock(snapshot_lock_file(snapshot_dir), shared=True):
+        manifest = load_snapshot_manifest(snapshot_dir)
+
+        if not snapshot_matches(manifest, spacy_model, revision):
+            return None
+
+        with open(os.path.join(snapshot_dir, SNAPSHOT_KNOWLEDGE), 'r') as f:
+            compiled = json.load(f)
+
+        doc_bin = DocBin().from_disk(os.path.join(snapshot_dir, SNAPSHOT_DOCS))
+        paragraph_vectors = load_vectors(os.path.join(snapshot_dir, SNAPSHOT_VECTORS))
+
+    docs = iter(doc_bin.get_docs(nlp.vocab))
+
+    knowledge = PageKnowledge(revision)
+    knowledge.body_docs = {header: [index_sentences(next(docs)) for _ in range(count)]
+                           for header, count in compiled["body_layout"].items()}
+    knowledge.infobox = {section: next(docs) for section in compiled["infobox_sections"]}
+    knowledge.infobox_paragraph = compiled["infobox_paragraph"]
+    if knowledge.infobox_paragraph is not None:
+        knowledge.infobox_doc = index_sentences(next(docs))
+
+    knowledge.body_topics = {header: [{wn.synset(name): count for name, count in topic_dict.items()}
+                                      for topic_dict in paragraphs_topics]
+                             for header, paragraphs_topics in compiled["topics"].items()}
+    knowledge.body_bags_of_words = {header: [set(bag) for bag in paragraph_bags]
+                                    for header, paragraph_bags in compiled["bags"].items()}
+    knowledge.lists = {title: tuple(items) for title, items in compiled["lists"].items()}
+
+    # Each section's vectors are a slice of the mapped matrix, nothing gets read in until it's scored
+    knowledge.paragraph_vectors = paragraph_vectors
+    if knowledge.paragraph_vectors is not None:
+        row = 0
+        for header, count in compiled["body_layout"].items():
+            knowledge.body_vectors[header] = knowledge.paragraph_vectors[row:row + count]
+            row += count
+    # Docs keep their text exactly, so the hashes can come straight from them
+    knowledge.section_hashes = {header: section_hash([doc.text for doc in paragraphs])
+                                for header, paragraphs in knowledge.body_docs.items()}
+
+    knowledge.build_indexes()
+
+    return knowledge
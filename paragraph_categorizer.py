@@ -1,21 +1,24 @@
-from typing import Dict
+from typing import Dict, List, Tuple
 
+import numpy as np
 import spacy
+from scipy.sparse import csc_matrix
 from nltk.corpus import wordnet as wn
 from nltk.corpus.reader import Synset
 from nltk.wsd import lesk
 from spacy.tokens.doc import Doc
 
+from hypernym_cache import HYPERNYM_CACHE
+
 
 def propogate_concept(concept: Synset, synset_counts: Dict[Synset, int] = None) -> Dict[Synset, int]:
     if synset_counts is None:
         synset_counts = {}
 
     if concept is not None:
-        synset_counts[concept] = synset_counts.get(concept, 0) + 1
-
-        for parent in concept.hypernyms():
-            propogate_concept(parent, synset_counts)
+        # Every hypernym path up from the concept adds one, same as walking the tree each time
+        for ancestor, (paths, _) in HYPERNYM_CACHE.closure(concept).items():
+            synset_counts[ancestor] = synset_counts.get(ancestor, 0) + paths
 
     return synset_counts
 
@@ -32,6 +35,29 @@ def get_topic_dict(doc: Doc):
     return topic_dict
 
 
+def get_topic_matrix(topics_by_header: Dict[str, List[Dict[Synset, int]]]) \
+        -> Tuple[csc_matrix, Dict[Synset, int], List[Tuple[str, int]]]:
+    # paragraph x synset counts, rows in document order. CSC since scoring pulls out one synset column at a time.
+    synset_columns: Dict[Synset, int] = {}
+    paragraph_rows: List[Tuple[str, int]] = []
+    rows, columns, counts = [], [], []
+
+    for header, paragraphs_topics in topics_by_header.items():
+        for i, topic_dict in enumerate(paragraphs_topics):
+            row = len(paragraph_rows)
+            paragraph_rows.append((header, i))
+
+            for synset, count in topic_dict.items():
+                rows.append(row)
+                columns.append(synset_columns.setdefault(synset, len(synset_columns)))
+                counts.append(count)
+
+    matrix = csc_matrix((np.array(counts, dtype=np.float64), (rows, columns)),
+                        shape=(len(paragraph_rows), len(synset_columns)))
+
+    return matrix, synset_columns, paragraph_rows
+
+
 if __name__ == "__main__":
     nlp = spacy.load("en_core_web_sm")
 
@@ -0,0 +1,138 @@
+import heapq
+import json
+import sys
+import time
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+from spacy.tokens.doc import Doc
+
+from dense_retriever import has_word_vectors, normalized_vector
+from page_knowledge import CorpusKnowledge
+from wiki_daemon import WikiDaemon, WIKI_PAGES
+
+QUESTIONS_FILE = "benchmark_questions.jsonl"
+REPORT_FILE = "ranker_comparison.json"
+RANKERS = ("bag", "bm25", "dense")
+# Paragraphs handed to the transformer, the scores at each smaller k show what cutting it would cost
+TOP_K = 3
+
+
+def rank_paragraphs(wiki_daemon: WikiDaemon, ranker: str, question_bag_of_words: Set[str],
+                    question_vector: np.ndarray, corpus: CorpusKnowledge) -> List[Tuple[float, Doc]]:
+    if ranker == "dense":
+        return wiki_daemon.rank_paragraphs_from_vector(question_vector, TOP_K, corpus)
+
+    wiki_daemon.fallback_ranker = ranker
+    return wiki_daemon.rank_paragraphs_from_fallback(question_bag_of_words, corpus)
+
+
+def compare_rankers(questions_file: str = QUESTIONS_FILE, report_file: str = REPORT_FILE) -> Dict:
+    with open(questions_file, 'r') as f:
+        questions = [json.loads(line) for line in f if line.strip() != ""]
+
+    wiki_daemon = WikiDaemon(WIKI_PAGES)
+    wiki_daemon.reload_spacy_docs()
+    corpus = wiki_daemon.corpus
+
+    rankers = [ranker for ranker in RANKERS if ranker != "dense" or has_word_vectors(wiki_daemon.nlp)]
+    if "dense" not in rankers:
+        print(f"{wiki_daemon.spacy_model} has no word vectors, leaving dense out")
+
+    # Which body paragraph a doc is, for the report
+    paragraph_names = {id(doc): f"{header} #{i}" for knowledge in corpus.pages.values()
+                       for header, paragraphs in knowledge.body_docs.items() for i, doc in enumerate(paragraphs)}
+
+    question_reports = []
+    rank_times: Dict[str, List[float]] = {ranker: [] for ranker in rankers}
+    # ranker -> best QA score among its top k paragraphs, for every k up to TOP_K
+    best_scores_at_k: Dict[str, List[List[float]]] = {ranker: [] for ranker in rankers}
+    wins: Dict[str, int] = {ranker: 0 for ranker in rankers}
+
+    for question in questions:
+        text = wiki_daemon.preprocess_question_string(question["question"])
+        question_doc = wiki_daemon.nlp(text)
+        question_bag_of_words = set(token.text.lower() for token in question_doc if not token.is_stop)
+        question_synsets = [token._.wordnet.synsets()[0] for token in question_doc
+                            if not token.is_stop and len(token._.wordnet.synsets()) > 0]
+        question_vector = normalized_vector(question_doc)
+
+        report = {
+            "question_id": question.get("question_id"),
+            "question": text,
+            # In the real cascade the fallback ranker only runs when this is false
+            "synset_hit": len(wiki_daemon.rank_paragraphs_from_synsets(question_synsets, corpus)) > 0
+        }
+
+        for ranker in rankers:
+            rank_start = time.perf_counter()
+            paragraph_scores = heapq.nlargest(TOP_K, rank_paragraphs(wiki_daemon, ranker, question_bag_of_words,
+                                                                     question_vector, corpus),
+                                              key=lambda item: item[0])
+            rank_times[ranker].append(time.perf_counter() - rank_start)
+
+            best_score, best_answer = 0.0, None
+            scores_at_k = []
+            if len(paragraph_scores) > 0:
+                results = wiki_daemon.transformer.answer_questions(text, [doc.text for _, doc in paragraph_scores])
+                for result, (_, doc) in zip(results, paragraph_scores):
+                    if result['score'] > best_score:
+                        best_score = result['score']
+                        best_answer = wiki_daemon.get_sentence_from_char_idx(doc, result['start']).text
+                    scores_at_k.append(best_score)
+            # Fewer than TOP_K candidates means a smaller k wouldn't have lost anything
+            scores_at_k += [best_score] * (TOP_K - len(scores_at_k))
+
+            best_scores_at_k[ranker].append(scores_at_k)
+            report[ranker] = {
+                "top_paragraphs": [[paragraph_names[id(doc)], round(score, 4)] for score, doc in paragraph_scores],
+                "best_qa_score": round(best_score, 4),
+                "best_qa_score_at_k": [round(score, 4) for score in scores_at_k],
+                "answer": best_answer
+            }
+
+        # How many of each ranker's picks the plain bag of words ranker also picked
+        report["top_overlap_with_bag"] = {
+            ranker: len({name for name, _ in report["bag"]["top_paragraphs"]} &
+                        {name for name, _ in report[ranker]["top_paragraphs"]})
+            for ranker in rankers if ranker != "bag"}
+
+        question_scores = {ranker: report[ranker]["best_qa_score"] for ranker in rankers}
+        top_score = max(question_scores.values())
+        leaders = [ranker for ranker, score in question_scores.items() if score == top_score]
+        if len(leaders) == 1:
+            wins[leaders[0]] += 1
+
+        question_reports.append(report)
+
+    summary = {
+        ranker: {
+            "mean_best_qa_score": round(float(np.mean([scores[-1] for scores in best_scores_at_k[ranker]])), 4),
+            "mean_best_qa_score_at_k": [round(float(score), 4)
+                                        for score in np.mean(best_scores_at_k[ranker], axis=0)],
+            "median_rank_ms": round(float(np.median(rank_times[ranker])) * 1000, 3),
+            "questions_won": wins[ranker]
+        }
+        for ranker in rankers
+    }
+    summary["mean_top_overlap_with_bag"] = {
+        ranker: round(float(np.mean([report["top_overlap_with_bag"][ranker] for report in question_reports])), 3)
+        for ranker in rankers if ranker != "bag"}
+
+    with open(report_file, 'w') as f:
+        json.dump({"summary": summary, "questions": question_reports}, f, indent=1, sort_keys=True)
+
+    for ranker in rankers:
+        print(f"{ranker:<6} mean best QA score {summary[ranker]['mean_best_qa_score']:.4f} "
+              f"(by k: {', '.join(f'{score:.4f}' for score in summary[ranker]['mean_best_qa_score_at_k'])}), "
+              f"median rank time {summary[ranker]['median_rank_ms']:.3f} ms, "
+              f"highest QA score on {summary[ranker]['questions_won']}/{len(question_reports)} questions")
+    print(f"Average top-{TOP_K} overlap with bag: {summary['mean_top_overlap_with_bag']}")
+    print(f"Wrote {report_file}")
+
+    return summary
+
+
+if __name__ == "__main__":
+    compare_rankers(sys.argv[1] if len(sys.argv) > 1 else QUESTIONS_FILE,
+                    sys.argv[2] if len(sys.argv) > 2 else REPORT_FILE)
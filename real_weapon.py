@@ -1,31 +1,403 @@
-from transformers import pipeline
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import AutoModelForQuestionAnswering, AutoTokenizer, pipeline
+
+QA_MODEL = "deepset/roberta-base-squad2"
+# Distilled from QA_MODEL, same tokenizer and SQuAD 2.0 no-answer handling, a fraction of the compute
+QA_SMALL_MODEL = "deepset/tinyroberta-squad2"
+# Ask the small model first and only hand the question to QA_MODEL when it isn't confident
+QA_CASCADE = os.environ.get("POLYVOICE_QA_CASCADE", "0") == "1"
+# The small model's answer stands if it scores at least this many times the cutoff the caller holds answers to.
+# Under that it's close enough to the cutoff that the full model gets the final say.
+ESCALATION_BAND = 1.5
+QA_BATCH_SIZE = 8
+# fp32 is plain PyTorch, int8 quantizes the linear layers on load, onnx runs an exported copy on ONNX Runtime
+QA_BACKENDS = ("fp32", "int8", "onnx")
+QA_BACKEND = os.environ.get("POLYVOICE_QA_BACKEND", "fp32")
+# How far a backend's scores can drift from fp32's before the parity check calls it out
+PARITY_SCORE_TOLERANCE = 0.05
+# Same windowing and span limits the question-answering pipeline uses by default
+QA_MAX_SEQ_LEN = 384
+QA_DOC_STRIDE = 128
+QA_MAX_QUESTION_LEN = 64
+QA_MAX_ANSWER_LEN = 15
+# ONNX exports live here, one directory per model so the cascade's two models don't overwrite each other
+ONNX_EXPORT_DIR = "qa_model.onnx"
+
+
+def onnx_model_dir(model_name: str) -> str:
+    # The ONNX export takes a while, so it's done once per model and kept here
+    return os.path.join(ONNX_EXPORT_DIR, model_name.replace('/', '_'))
+
+
+def set_qa_threads(threads: int) -> None:
+    # Torch uses every core by default, a pool of workers all doing that just fight over them
+    torch.set_num_threads(threads)
+
+
+def load_qa_pipeline(backend: str = QA_BACKEND, model_name: str = QA_MODEL):
+    if backend == "fp32":
+        return pipeline("question-answering", model=model_name)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    if backend == "int8":
+        # Weights of every Linear go to int8 up front, activations get quantized on the fly each forward pass
+        model = torch.quantization.quantize_dynamic(AutoModelForQuestionAnswering.from_pretrained(model_name),
+                                                    {torch.nn.Linear}, dtype=torch.qint8)
+
+        return pipeline("question-answering", model=model, tokenizer=tokenizer)
+
+    if backend == "onnx":
+        # Only needed for this backend, so only imported for it
+        from onnxruntime import SessionOptions
+        from optimum.onnxruntime import ORTModelForQuestionAnswering
+
+        # ONNX Runtime has its own thread pool, keep it to the same share of cores as torch
+        session_options = SessionOptions()
+        session_options.intra_op_num_threads = torch.get_num_threads()
+
+        if os.path.isdir(onnx_model_dir(model_name)):
+            model = ORTModelForQuestionAnswering.from_pretrained(onnx_model_dir(model_name),
+                                                                 session_options=session_options)
+        else:
+            model = ORTModelForQuestionAnswering.from_pretrained(model_name, export=True,
+                                                                 session_options=session_options)
+            model.save_pretrained(onnx_model_dir(model_name))
+
+        return pipeline("question-answering", model=model, tokenizer=tokenizer)
+
+    raise ValueError(f"Unknown QA backend {backend}, pick one of {', '.join(QA_BACKENDS)}")
+
+
+class ContextEncoding:
+
+    def __init__(self, text: str, input_ids: List[int], word_spans: List[Tuple[int, int]]):
+        # A context tokenized on its own, which is exactly how it gets tokenized as the second half of a pair
+        self.text = text
+        self.input_ids = input_ids
+        # Character span of the word each token belongs to, answers get widened to whole words like the pipeline does
+        self.word_spans = word_spans
 
 
 class QAModel:
 
-    def __init__(self):
-        self.nlp = pipeline("question-answering", model="deepset/roberta-base-squad2")
+    def __init__(self, batch_size: int = QA_BATCH_SIZE, backend: str = QA_BACKEND, model_name: str = QA_MODEL):
+        self.nlp = load_qa_pipeline(backend, model_name)
+        self.backend = backend
+        self.model_name = model_name
+        self.batch_size = batch_size
+
+        self.answered = 0
 
-    def answer_question(self, question: str, context: str):
+    def answer_question(self, question: str, context: str, cutoff: Optional[float] = None):
         result = self.nlp(question=question, context=context)
+        self.answered += 1
 
         return result
 
+    def answer_question_pairs(self, questions: List[str], contexts: List[str],
+                              cutoff: Optional[float] = None) -> List[Dict]:
+        # The pipeline pads the question/context pairs into batches and runs one forward pass per batch
+        if len(questions) == 0:
+            return []
 
-def main():
-    context = "Cal Poly has one of the largest college campuses in the United States. It owns 9,178 acres and is the second largest land-holding university in California. The lands are used for student education and include the main campus, two nearby agricultural lands, and two properties in Santa Cruz County. Part of the Cal Poly property is the Swanton Pacific Ranch, a 3,200-acre (1,300 ha) ranch located in Santa Cruz County, California, outside the town of Davenport. The ranch provides educational and research opportunities, encompasses rangeland, livestock, and forestry operations for the College of Agriculture, Food, and Environmental sciences, and fosters Cal Poly's Learn by Doing teaching philosophy of with emphasis on sustainable management of agricultural practices with a mix of laboratory experiments."
+        results = self.nlp(question=questions, context=contexts, batch_size=self.batch_size)
+
+        # A single pair comes back as a bare dict instead of a list
+        if isinstance(results, dict):
+            results = [results]
+
+        self.answered += len(results)
+
+        return results
+
+    def answer_questions(self, question: str, contexts: List[str], cutoff: Optional[float] = None,
+                         encodings: Optional[List[Optional[ContextEncoding]]] = None) -> List[Dict]:
+        # cutoff is the score the caller will hold the answers to. One model on its own has no use for it.
+        if encodings is not None:
+            return self.answer_encoded_questions([question] * len(contexts), contexts, encodings)
+
+        return self.answer_question_pairs([question] * len(contexts), contexts, cutoff)
+
+    def encode_contexts(self, contexts: List[str]) -> List[ContextEncoding]:
+        if len(contexts) == 0:
+            return []
+
+        tokenizer = self.nlp.tokenizer
+        batch = tokenizer(contexts, add_special_tokens=False, return_offsets_mapping=True)
+
+        encodings = []
+        for n, context in enumerate(contexts):
+            word_ids = batch.word_ids(n)
+            offsets = batch['offset_mapping'][n]
+            word_spans = [tuple(batch.word_to_chars(n, word_id)) if word_id is not None else tuple(offset)
+                          for word_id, offset in zip(word_ids, offsets)]
+            encodings.append(ContextEncoding(context, batch['input_ids'][n], word_spans))
+
+        return encodings
+
+    def answer_encoded_questions(self, questions: List[str], contexts: List[str],
+                                 encodings: List[Optional[ContextEncoding]]) -> List[Dict]:
+        # Only the questions get tokenized here, contexts come pre-tokenized from the per-revision cache. Anything
+        # that isn't cached gets tokenized now.
+        missing = [i for i, encoding in enumerate(encodings) if encoding is None or encoding.text != contexts[i]]
+        encodings = list(encodings)
+        for i, encoding in zip(missing, self.encode_contexts([contexts[i] for i in missing])):
+            encodings[i] = encoding
+
+        tokenizer = self.nlp.tokenizer
+        question_ids = {question: tokenizer(question, add_special_tokens=False)['input_ids'][:QA_MAX_QUESTION_LEN]
+                        for question in set(questions)}
+
+        # Every (pair, window) gets its own row, windows overlap by QA_DOC_STRIDE tokens like the pipeline's
+        windows = []
+        for pair, (question, encoding) in enumerate(zip(questions, encodings)):
+            ids = question_ids[question]
+            # Where the context starts inside the pair, found by building a pair around a one token placeholder
+            layout = tokenizer.build_inputs_with_special_tokens(ids, [-1])
+            context_start = layout.index(-1)
+            window_len = QA_MAX_SEQ_LEN - (len(layout) - 1)
+
+            window_start = 0
+            while True:
+                window_ids = encoding.input_ids[window_start:window_start + window_len]
+                input_ids = tokenizer.build_inputs_with_special_tokens(ids, window_ids)
+                windows.append((pair, window_start, context_start, len(window_ids), input_ids,
+                                tokenizer.create_token_type_ids_from_sequences(ids, window_ids)))
+
+                if window_start + window_len >= len(encoding.input_ids):
+                    break
+                window_start += window_len - QA_DOC_STRIDE
+
+        best: List[Optional[Dict]] = [None] * len(questions)
+
+        for batch_start in range(0, len(windows), self.batch_size):
+            batch = windows[batch_start:batch_start + self.batch_size]
+            start_logits, end_logits = self.forward([window[4] for window in batch], [window[5] for window in batch])
+
+            for row, (pair, window_start, context_start, context_len, _, _) in enumerate(batch):
+                answer = self.decode_window(start_logits[row], end_logits[row], encodings[pair], window_start,
+                                            context_start, context_len)
+
+                if best[pair] is None or answer['score'] > best[pair]['score']:
+                    best[pair] = answer
+
+        self.answered += len(questions)
+
+        return best
+
+    def forward(self, input_ids: List[List[int]], token_type_ids: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+        tokenizer = self.nlp.tokenizer
+        length = max(len(ids) for ids in input_ids)
+
+        inputs = {
+            "input_ids": torch.tensor([ids + [tokenizer.pad_token_id] * (length - len(ids)) for ids in input_ids]),
+            "attention_mask": torch.tensor([[1] * len(ids) + [0] * (length - len(ids)) for ids in input_ids])
+        }
+        if "token_type_ids" in tokenizer.model_input_names:
+            inputs["token_type_ids"] = torch.tensor([types + [0] * (length - len(types)) for types in token_type_ids])
 
+        with torch.no_grad():
+            output = self.nlp.model(**inputs)
+
+        return np.asarray(output.start_logits, dtype=np.float64), np.asarray(output.end_logits, dtype=np.float64)
+
+    def decode_window(self, start_logits: np.ndarray, end_logits: np.ndarray, encoding: ContextEncoding,
+                      window_start: int, context_start: int, context_len: int) -> Dict:
+        # Same scoring as the pipeline: softmax over the context tokens and the CLS token, CLS then zeroed out,
+        # best start * end product among spans up to QA_MAX_ANSWER_LEN tokens
+        if context_len == 0:
+            return {"score": 0.0, "start": 0, "end": 0, "answer": ""}
+
+        allowed = np.zeros(len(start_logits), dtype=bool)
+        allowed[0] = True
+        allowed[context_start:context_start + context_len] = True
+
+        start = np.exp(np.where(allowed, start_logits, -10000.0) - start_logits[allowed].max())
+        start /= start.sum()
+        end = np.exp(np.where(allowed, end_logits, -10000.0) - end_logits[allowed].max())
+        end /= end.sum()
+
+        context = slice(context_start, context_start + context_len)
+        candidates = np.tril(np.triu(np.outer(start[context], end[context])), QA_MAX_ANSWER_LEN - 1)
+        answer_start, answer_end = np.unravel_index(np.argmax(candidates), candidates.shape)
+
+        start_char = encoding.word_spans[window_start + answer_start][0]
+        end_char = encoding.word_spans[window_start + answer_end][1]
+
+        return {
+            "score": float(candidates[answer_start, answer_end]),
+            "start": int(start_char),
+            "end": int(end_char),
+            "answer": encoding.text[start_char:end_char]
+        }
+
+    def stats(self) -> Dict[str, float]:
+        return {"answered": self.answered}
+
+
+class CascadeQAModel:
+
+    def __init__(self, batch_size: int = QA_BATCH_SIZE, backend: str = QA_BACKEND,
+                 escalation_band: float = ESCALATION_BAND):
+        self.small = QAModel(batch_size, backend, QA_SMALL_MODEL)
+        self.large = QAModel(batch_size, backend, QA_MODEL)
+        self.escalation_band = escalation_band
+
+        # Concurrent inquiry stages can answer at the same time
+        self.stats_lock = threading.Lock()
+        self.answered = 0
+        self.escalated = 0
+
+    def answer_question(self, question: str, context: str, cutoff: Optional[float] = None):
+        return self.answer_question_pairs([question], [context], cutoff)[0]
+
+    def answer_question_pairs(self, questions: List[str], contexts: List[str], cutoff: Optional[float] = None,
+                              encodings: Optional[List[Optional[ContextEncoding]]] = None) -> List[Dict]:
+        if encodings is None:
+            results = self.small.answer_question_pairs(questions, contexts)
+        else:
+            results = self.small.answer_encoded_questions(questions, contexts, encodings)
+
+        # Without a cutoff there's no telling which answers are good enough, so the full model decides all of them
+        band = None if cutoff is None else cutoff * self.escalation_band
+        escalate = [i for i, result in enumerate(results) if band is None or result['score'] < band]
+
+        if len(escalate) > 0:
+            if encodings is None:
+                large_results = self.large.answer_question_pairs([questions[i] for i in escalate],
+                                                                 [contexts[i] for i in escalate])
+            else:
+                large_results = self.large.answer_encoded_questions([questions[i] for i in escalate],
+                                                                    [contexts[i] for i in escalate],
+                                                                    [encodings[i] for i in escalate])
+            for i, result in zip(escalate, large_results):
+                results[i] = result
+
+        with self.stats_lock:
+            self.answered += len(results)
+            self.escalated += len(escalate)
+
+        return results
+
+    def answer_questions(self, question: str, contexts: List[str], cutoff: Optional[float] = None,
+                         encodings: Optional[List[Optional[ContextEncoding]]] = None) -> List[Dict]:
+        return self.answer_question_pairs([question] * len(contexts), contexts, cutoff, encodings)
+
+    def encode_contexts(self, contexts: List[str]) -> List[ContextEncoding]:
+        # Both models share the roberta tokenizer, so one encoding serves either of them
+        return self.large.encode_contexts(contexts)
+
+    def stats(self) -> Dict[str, float]:
+        with self.stats_lock:
+            return {
+                "answered": self.answered,
+                "escalated": self.escalated,
+                "escalation_rate": self.escalated / self.answered if self.answered > 0 else 0.0
+            }
+
+
+def load_qa_model(batch_size: int = QA_BATCH_SIZE, backend: str = QA_BACKEND, cascade: bool = QA_CASCADE):
+    return CascadeQAModel(batch_size, backend) if cascade else QAModel(batch_size, backend)
+
+
+PARITY_CONTEXT = "Cal Poly has one of the largest college campuses in the United States. It owns 9,178 acres and is the second largest land-holding university in California. The lands are used for student education and include the main campus, two nearby agricultural lands, and two properties in Santa Cruz County. Part of the Cal Poly property is the Swanton Pacific Ranch, a 3,200-acre (1,300 ha) ranch located in Santa Cruz County, California, outside the town of Davenport. The ranch provides educational and research opportunities, encompasses rangeland, livestock, and forestry operations for the College of Agriculture, Food, and Environmental sciences, and fosters Cal Poly's Learn by Doing teaching philosophy of with emphasis on sustainable management of agricultural practices with a mix of laboratory experiments."
+
+PARITY_INFOBOX = "The motto of Cal Poly is Discere Faciendo. The English motto of Cal Poly is Learn by doing. The type of Cal Poly is Public university. The president of Cal Poly is Jeffrey Armstrong. The colors of Cal Poly are Green and Gold. The nickname of Cal Poly is Mustangs. The mascot of Cal Poly is Musty the Mustang."
+
+PARITY_PAIRS = [
+    ("How much land does Cal Poly own?", PARITY_CONTEXT),
+    ("What is the Swanton Pacific Ranch?", PARITY_CONTEXT),
+    ("What is Cal Poly's teaching philosophy?", PARITY_CONTEXT),
+    ("What is Swanton Pacific Ranch used for?", PARITY_CONTEXT),
+    ("Who is the president of Cal Poly?", PARITY_INFOBOX),
+    ("What are Cal Poly's colors?", PARITY_INFOBOX),
+    ("What is the mascot?", PARITY_INFOBOX),
+    ("What is the motto in English?", PARITY_INFOBOX)
+]
+
+
+def compare_backends(backends: List[str] = QA_BACKENDS, repeats: int = 5) -> Dict[str, Dict]:
+    # Answers from every backend next to fp32's on the same pairs, plus how long one pair takes
+    report = {}
+    reference = None
+
+    for backend in ["fp32"] + [backend for backend in backends if backend != "fp32"]:
+        load_start = time.time()
+        model = QAModel(backend=backend)
+        load_seconds = time.time() - load_start
+
+        # First call warms up the backend, keep it out of the timings
+        model.answer_question(*PARITY_PAIRS[0])
+
+        latencies = []
+        results = []
+        for question, context in PARITY_PAIRS:
+            for _ in range(repeats):
+                call_start = time.perf_counter()
+                result = model.answer_question(question, context)
+                latencies.append(time.perf_counter() - call_start)
+            results.append(result)
+
+        if reference is None:
+            reference = results
+
+        span_matches = sum((result['start'], result['end']) == (expected['start'], expected['end'])
+                           for result, expected in zip(results, reference))
+        score_drift = max(abs(result['score'] - expected['score']) for result, expected in zip(results, reference))
+
+        # The pre-tokenized context path has to agree with this backend's own pipeline
+        contexts = [context for _, context in PARITY_PAIRS]
+        encoded_results = model.answer_encoded_questions([question for question, _ in PARITY_PAIRS], contexts,
+                                                         model.encode_contexts(contexts))
+        encoded_span_matches = sum((result['start'], result['end']) == (expected['start'], expected['end'])
+                                   for result, expected in zip(encoded_results, results))
+        encoded_score_drift = max(abs(result['score'] - expected['score'])
+                                  for result, expected in zip(encoded_results, results))
+
+        report[backend] = {
+            "load_seconds": load_seconds,
+            "p50_ms": sorted(latencies)[len(latencies) // 2] * 1000,
+            "mean_ms": sum(latencies) / len(latencies) * 1000,
+            "span_matches": span_matches,
+            "max_score_drift": score_drift,
+            "parity": span_matches == len(PARITY_PAIRS) and score_drift <= PARITY_SCORE_TOLERANCE,
+            "encoded_span_matches": encoded_span_matches,
+            "encoded_max_score_drift": encoded_score_drift,
+            "answers": [result['answer'] for result in results]
+        }
+
+        print(f"{backend:<5} loaded in {load_seconds:.1f}s, p50 {report[backend]['p50_ms']:.1f} ms, "
+              f"mean {report[backend]['mean_ms']:.1f} ms, spans matching fp32 {span_matches}/{len(PARITY_PAIRS)}, "
+              f"max score drift {score_drift:.4f}{'' if report[backend]['parity'] else '  <-- PARITY FAILED'}")
+        print(f"{backend:<5} pre-tokenized contexts: spans matching the pipeline {encoded_span_matches}/"
+              f"{len(PARITY_PAIRS)}, max score drift {encoded_score_drift:.4f}")
+
+    return report
+
+
+def main():
     model = QAModel()
 
-    questions = [
-        "How much land does Cal Poly own?",
-        "What is the Swanton Pacific Ranch?",
-        "What is Cal Poly's teaching philosophy?",
-        "What is Swanton Pacific Ranch used for?"
-    ]
+    questions = [question for question, context in PARITY_PAIRS if context == PARITY_CONTEXT]
     for question in questions:
-        print(model.answer_question(question, context))
+        print(model.answer_question(question, PARITY_CONTEXT))
+
+    # Same questions, one batched call
+    for result in model.answer_question_pairs(questions, [PARITY_CONTEXT] * len(questions)):
+        print(result)
 
 
 if __name__ == "__main__":
-    main()
+    # real_weapon.py compare [backend ...] checks the other backends against fp32
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare_backends(sys.argv[2:] if len(sys.argv) > 2 else QA_BACKENDS)
+    else:
+        main()
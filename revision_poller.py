@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from file_lock import file_lock
+from wiki_fetcher import PageRevision, WikiFetcher
+
+REVISION_MANIFEST_FILE = "revisions.json"
+
+
+class RevisionManifest:
+
+    def __init__(self, manifest_file: str = REVISION_MANIFEST_FILE):
+        # title -> {"revid": int, "timestamp": str} for every page we have files for
+        self.manifest_file = manifest_file
+        self.revisions: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self) -> None:
+        try:
+            with open(self.manifest_file, 'r') as f:
+                revisions = json.load(f)
+        except (FileNotFoundError, ValueError):
+            revisions = {}
+
+        self.revisions = revisions
+
+    def get_revision_id(self, title: str) -> Optional[int]:
+        revision = self.revisions.get(title)
+
+        return None if revision is None else revision['revid']
+
+    def get_timestamp(self, title: str) -> Optional[str]:
+        revision = self.revisions.get(title)
+
+        return None if revision is None else revision['timestamp']
+
+    def record(self, revision: PageRevision) -> None:
+        self.record_all([revision])
+
+    def record_all(self, revisions: Iterable[PageRevision]) -> None:
+        # The whole file gets rewritten either way, so bulk writers hand over many pages at once. The lock file
+        # covers other processes (the pool's builder, snapshot-builder, dump_ingester), the thread lock covers
+        # threads sharing this manifest
+        with self.lock, file_lock(f"{self.manifest_file}.lock"):
+            # Other processes write here too, so start from what's on disk and only change our own pages
+            self.reload()
+            self.revisions = dict(self.revisions)
+            for revision in revisions:
+                self.revisions[revision.title] = {"revid": revision.revision_id, "timestamp": revision.timestamp}
+
+            scratch_file = f"{self.manifest_file}.{os.getpid()}.{threading.get_ident()}"
+            with open(scratch_file, 'w') as f:
+                json.dump(self.revisions, f, indent=1)
+
+            os.replace(scratch_file, self.manifest_file)
+
+
+class RevisionPoller:
+
+    def __init__(self, fetcher: WikiFetcher, manifest: RevisionManifest):
+        self.fetcher = fetcher
+        self.manifest = manifest
+
+    def poll(self, titles: List[str]) -> Dict[str, PageRevision]:
+        # One query per 50 titles, and only pages whose revision id moved come back
+        latest = self.fetcher.get_latest_revisions(titles)
+
+        return {title: revision for title, revision in latest.items()
+                if self.manifest.get_revision_id(title) != revision.revision_id}
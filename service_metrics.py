@@ -0,0 +1,144 @@
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Upper bounds in seconds, from a cache hit up to a full reload
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   300.0)
+
+# (metric name, labels) where labels is a tuple of (label, value) pairs, so keys stay hashable and picklable
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def metric_key(name: str, labels: Optional[Dict[str, str]] = None) -> MetricKey:
+    return name, tuple(sorted((labels or {}).items()))
+
+
+class Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus one for everything past the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other: 'Histogram') -> None:
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.counters: Dict[MetricKey, float] = {}
+        self.gauges: Dict[MetricKey, float] = {}
+        self.histograms: Dict[MetricKey, Histogram] = {}
+        # Recording is a dict update under a lock, cheap enough to sit on the inquiry path
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, amount: float = 1) -> None:
+        key = metric_key(name, labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        with self.lock:
+            self.gauges[metric_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        key = metric_key(name, labels)
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def snapshot(self) -> 'MetricsRegistry':
+        # A copy that can be pickled back through the daemon pipe and merged on the other end
+        copy = MetricsRegistry()
+
+        with self.lock:
+            copy.counters = dict(self.counters)
+            copy.gauges = dict(self.gauges)
+            for key, histogram in self.histograms.items():
+                copy.histograms[key] = Histogram(histogram.buckets)
+                copy.histograms[key].merge(histogram)
+
+        return copy
+
+    def __getstate__(self):
+        return {"counters": self.counters, "gauges": self.gauges, "histograms": self.histograms}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def merge_metrics(registries: Iterable[MetricsRegistry]) -> MetricsRegistry:
+    # Counters and histograms add up across workers. Gauges should carry a worker label if they differ per worker.
+    merged = MetricsRegistry()
+
+    for registry in registries:
+        for key, value in registry.counters.items():
+            merged.counters[key] = merged.counters.get(key, 0) + value
+        merged.gauges.update(registry.gauges)
+        for key, histogram in registry.histograms.items():
+            if key not in merged.histograms:
+                merged.histograms[key] = Histogram(histogram.buckets)
+            merged.histograms[key].merge(histogram)
+
+    return merged
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    labels = labels + extra
+    if len(labels) == 0:
+        return ""
+
+    return "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+def render_metrics(registry: MetricsRegistry) -> str:
+    # Prometheus text exposition format
+    lines: List[str] = []
+    typed = set()
+
+    def type_line(name: str, kind: str):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(registry.counters.items()):
+        type_line(name, "counter")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for (name, labels), value in sorted(registry.gauges.items()):
+        type_line(name, "gauge")
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+    for (name, labels), histogram in sorted(registry.histograms.items()):
+        type_line(name, "histogram")
+
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels, (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels(labels, (('le', '+Inf'),))} {histogram.count}")
+        lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+    return "\n".join(lines) + "\n"
+
+
+# One per process. The daemons record the question path into theirs, the web app records the pool's side.
+METRICS = MetricsRegistry()
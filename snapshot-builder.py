@@ -0,0 +1,36 @@
+import sys
+import time
+
+from hypernym_cache import HYPERNYM_CACHE
+from page_knowledge import load_snapshot_manifest, save_snapshot, snapshot_dir_for, snapshot_matches
+from wiki_daemon import WikiDaemon, WIKI_PAGES
+
+
+def build_snapshot(wiki_pages=WIKI_PAGES):
+    wiki_daemon = WikiDaemon(wiki_pages, load_transformer=False)
+
+    # Pages with a newer revision get downloaded, and their snapshots rebuilt from the current ones
+    revisions = wiki_daemon.refresh_pages()
+
+    for wiki_page, page in wiki_daemon.pages.items():
+        revision = page.get_revision_key()
+        if revision is None:
+            print(f"No local revision for {wiki_page}, can't key a snapshot on it")
+            continue
+
+        if wiki_page in revisions or \
+                snapshot_matches(load_snapshot_manifest(snapshot_dir_for(wiki_page)), wiki_daemon.spacy_model,
+                                 revision):
+            print(f"Snapshot of revision {revision} for {wiki_page} is up to date")
+            continue
+
+        build_start = time.time()
+        knowledge = page.build_knowledge(revision)
+        save_snapshot(knowledge, snapshot_dir_for(wiki_page), wiki_daemon.spacy_model)
+        print(f"Built snapshot of revision {revision} for {wiki_page} in {time.time() - build_start} seconds")
+
+    HYPERNYM_CACHE.save()
+
+
+if __name__ == "__main__":
+    build_snapshot(sys.argv[1:] if len(sys.argv) > 1 else WIKI_PAGES)
@@ -0,0 +1,32 @@
+import pytest
+
+spacy = pytest.importorskip("spacy")
+
+from answer_cache import normalize_question
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    try:
+        nlp = spacy.load("en_core_web_sm")
+    except OSError:
+        pytest.skip("en_core_web_sm isn't installed")
+    # Same custom stop words as wiki_daemon.get_spacy_pipeline
+    nlp.Defaults.stop_words |= {"cal", "poly", "polytechnic", "university"}
+    return nlp
+
+
+@pytest.mark.parametrize("question, other", [
+    ("Who is the president of Cal Poly?", "Who is the first president of Cal Poly?"),
+    ("who was the last provost", "who was the provost"),
+    ("Who was president before Baker?", "Who was president after Baker?"),
+    ("What are the top two majors?", "What are the top three majors?"),
+    ("Which college has the most students?", "Which college has the least students?"),
+])
+def test_meaning_bearing_stop_words_get_their_own_keys(nlp, question, other):
+    assert normalize_question(nlp(question)) != normalize_question(nlp(other))
+
+
+def test_rephrasings_share_a_key(nlp):
+    assert normalize_question(nlp("Who is the president of Cal Poly?")) == \
+        normalize_question(nlp("who's president of cal poly"))
@@ -1,15 +1,18 @@
 import datetime
+import heapq
+import os
 import re
 import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.connection import Connection
-from typing import Dict, Optional, List, Tuple, Set, Union
+from typing import Callable, Dict, Optional, List, Tuple, Set, Union
 
-import requests
 import spacy
-from dateutil import parser as date_parser
 import time
-import wptools
 import json
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup
 
@@ -19,97 +22,113 @@ from nltk.wsd import lesk
 from spacy.tokens.doc import Doc
 from spacy.tokens.span import Span
 
-from body_extractor import wikitext_docs_by_title, wikitext_bag_by_title
-from infobox_extractor import wikitext_infobox_docs, wikitext_infobox_numbers, wikibox_to_para
+from answer_cache import AnswerCache, normalize_question
+from dense_retriever import has_word_vectors, normalized_vector, paragraph_vectors_by_title, top_k_rows
+from body_extractor import wikitext_bag_by_title, markup_paragraphs_by_title, index_sentences, parse_texts, \
+    sentence_from_char_idx
+from inquiry_trace import InquiryTrace
+from infobox_extractor import infobox_fields_clean, wikitext_infobox_docs, wikitext_infobox_fields, \
+    wikibox_to_para
+from hypernym_cache import HYPERNYM_CACHE
+from page_knowledge import CorpusKnowledge, PageKnowledge, load_snapshot, save_snapshot, section_hash, snapshot_dir_for
 from paragraph_categorizer import get_topic_dict
-from list_extractor import get_wikitext_lists, try_list_question
-from real_weapon import QAModel
+from list_extractor import get_markup_lists, try_list_question
+from real_weapon import load_qa_model, set_qa_threads
+from revision_poller import RevisionManifest, RevisionPoller
+from service_metrics import METRICS, MetricsRegistry
+from wiki_fetcher import PageRevision, WikiFetcher, WIKI_API_URL
 
 # Your IDE will probably tell you that you don't need this import. You need this import. -SF
 from spacy_wordnet.wordnet_annotator import WordnetAnnotator
 
-SPACY_MODEL = "en_core_web_sm"
+# en_core_web_md or lg bring the word vectors dense retrieval needs, at the cost of a bigger worker
+SPACY_MODEL = os.environ.get("POLYVOICE_SPACY_MODEL", "en_core_web_sm")
 WIKI_PAGE = "California_Polytechnic_State_University"
+# Related articles (departments, athletics, the CSU system...) to answer from next to the main page, comma separated
+WIKI_PAGES = [WIKI_PAGE] + [title.strip() for title in os.environ.get("POLYVOICE_EXTRA_PAGES", "").split(",")
+                            if title.strip() != ""]
 VERSION = "0.0.2"
 HEADERS = {'accept-encoding': 'gzip', 'User-Agent': f"Poly Assistant/{VERSION}"}
-STORED_DATE_FORMAT = "%Y-%m-%d %H:%M:%S%z"
 ANSWER_CONF_CUTOFF = 0.20
 BOOLEAN_ANSWER_CONF_THRESH = 0.20
 BAG_OF_WORDS_CONF_CUTOFF = 0.13
 INFOBOX_CONF_CUTOFF = 0.44
+# What paragraph answers get held to when the QA model wants to know, the strictest of the cutoffs above so a small
+# model in front never decides a borderline answer by itself
+PARAGRAPH_QA_CUTOFF = max(ANSWER_CONF_CUTOFF, BOOLEAN_ANSWER_CONF_THRESH, BAG_OF_WORDS_CONF_CUTOFF)
 UPDATE_PERIOD_SECS = 3600
+ANSWER_CACHE_SIZE = 256
+SPACY_BATCH_SIZE = 64
+# Processes nlp.pipe parses in. Past 1, spacy_wordnet still runs in this process (see body_extractor.parse_texts), so
+# only the parsing itself gets spread out.
+SPACY_N_PROCESS = 1
+# What a message down the daemon pipe asks for
+INQUIRY_MESSAGE = "inquiry"
+METRICS_MESSAGE = "metrics"
+RELOAD_MESSAGE = "reload"
+NO_ANSWER = "Sorry, not sure about that one."
+WIKI_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Run infobox QA and paragraph retrieval + QA side by side instead of one after the other
+CONCURRENT_STAGES = os.environ.get("POLYVOICE_CONCURRENT_STAGES", "0") == "1"
+# Pick paragraphs by embedding similarity instead of WordNet topics and shared words. Needs a spaCy model with word
+# vectors (POLYVOICE_SPACY_MODEL=en_core_web_md or lg), it stays off otherwise.
+DENSE_RETRIEVAL = os.environ.get("POLYVOICE_DENSE_RETRIEVAL", "0") == "1"
+# Same 3 paragraphs the other rankers hand the transformer. Only worth lowering once ranker-comparison.py shows the
+# dense picks' best QA score holds up with fewer.
+DENSE_TOP_K = 3
+# Send the transformer a few sentences around the one sharing the most words with the question instead of the whole
+# paragraph. Answers still resolve to a sentence of the full paragraph.
+SENTENCE_WINDOWS = os.environ.get("POLYVOICE_SENTENCE_WINDOWS", "0") == "1"
+# Sentences kept on each side of the best one
+SENTENCE_WINDOW_RADIUS = 1
+# What ranks paragraphs when WordNet topics come up empty: "bag" (shared word count) or "bm25"
+FALLBACK_RANKER = os.environ.get("POLYVOICE_FALLBACK_RANKER", "bag")
 
 
 def get_spacy_pipeline(base_model=SPACY_MODEL) -> Language:
-    nlp = spacy.load(SPACY_MODEL)
+    nlp = spacy.load(base_model)
     nlp.Defaults.stop_words |= {"cal", "poly", "polytechnic", "university"}
     nlp.add_pipe('spacy_wordnet', after='tagger', config={'lang': 'en'})
 
     return nlp
 
 
-class WikiDaemon:
+class WikiPage:
 
-    def __init__(self, wiki_page, spacy_model=SPACY_MODEL):
+    def __init__(self, wiki_page, nlp: Language, fetcher: WikiFetcher, manifest: RevisionManifest,
+                 spacy_model=SPACY_MODEL, spacy_batch_size=SPACY_BATCH_SIZE, spacy_n_process=SPACY_N_PROCESS,
+                 on_swap: Optional[Callable[['WikiPage'], None]] = None):
         # Check if local files are downloaded
         self.wiki_page = wiki_page
-        self.last_change_date = None
-
-        # NLP pipeline
-        self.nlp = get_spacy_pipeline(spacy_model)
-
-        # Transformer pipeline
-        self.transformer = QAModel()
-
-        # NLP persistent attributes
-        self.body_docs = {}
-        self.body_topics = {}
-        self.body_bags_of_words = {}
-
-        self.infobox = {}
-        self.infobox_numbers = {}
-        # Store doc tables, info box here
-
-    def get_online_page_revision(self) -> datetime:
-        revisions_query = requests.get(
-            f"https://en.wikipedia.org/w/api.php?action=query&format=json&prop=revisions&titles={self.wiki_page}&formatversion=2&redirects=1",
-            headers=HEADERS).json()['query']['pages']
-
-        last_change = revisions_query[0]['revisions'][0]['timestamp']
-        last_change_date = date_parser.parse(last_change)
+        self.fetcher = fetcher
+        # Which revision the local files hold, shared with the other pages
+        self.manifest = manifest
 
-        return last_change_date
+        self.nlp = nlp
+        self.spacy_model = spacy_model
+        self.spacy_batch_size = spacy_batch_size
+        self.spacy_n_process = spacy_n_process
 
-    def get_our_page_revision(self) -> Optional[datetime.datetime]:
-        if self.last_change_date is not None:
-            return self.last_change_date
+        # NLP persistent attributes. Docs, topics, bags, lists and the infobox (plus the infobox in paragraph form, so
+        # inquiry only has to run the transformer on it) all live here, built once per revision.
+        self.knowledge = PageKnowledge()
 
-        try:
-            with open(f"{self.wiki_page}.lastmodified", 'r') as f:
-                text = f.read()
-                try:
-                    old_time = datetime.datetime.strptime(text.strip(), STORED_DATE_FORMAT)
-                except ValueError:
-                    old_time = None
-        except FileNotFoundError:
-            old_time = None
-
-        return old_time
+        # Called whenever new knowledge gets swapped in, so the daemon can update its view of the corpus
+        self.on_swap = on_swap
 
-    def write_page_revision(self, last_change_date: datetime = None) -> None:
-        if last_change_date is None:
-            last_change_date = self.last_change_date
+        # How long each stage of the last reload_spacy_docs took, in seconds
+        self.reload_timings: Dict[str, float] = {}
 
-        with open(f"{self.wiki_page}.lastmodified", 'w') as f:
-            f.write(last_change_date.strftime(STORED_DATE_FORMAT))
+    def get_our_page_revision_id(self) -> Optional[int]:
+        return self.manifest.get_revision_id(self.wiki_page)
 
-    def local_revision_out_of_date(self, online_revision=None) -> bool:
-        local_revision = self.get_our_page_revision()
+    def get_revision_key(self) -> Optional[str]:
+        revision_id = self.get_our_page_revision_id()
 
-        if online_revision is None:
-            online_revision = self.get_online_page_revision()
+        return None if revision_id is None else str(revision_id)
 
-        return local_revision is None or local_revision < online_revision
+    def write_page_revision(self, revision: PageRevision) -> None:
+        self.manifest.record(revision)
 
     def load_wiki_infobox(self) -> Dict:
         with open(f"{self.wiki_page}.infobox", 'r') as f:
@@ -117,49 +136,56 @@ class WikiDaemon:
 
         return info_box
 
-    def download_wiki_infobox(self) -> None:
-        wiki_parse = wptools.page(self.wiki_page).get_parse()
-        info_box = wiki_parse.data['infobox']
+    def download_wiki_page(self, revision_id: Optional[int] = None) -> None:
+        # One parse request for both HTML and wikitext, and the infobox comes out of the wikitext
+        self.store_wiki_page(self.fetcher.fetch_page(self.wiki_page, revision_id))
 
-        with open(f"{self.wiki_page}.infobox", 'w') as f:
-            json.dump(info_box, f)
+    def store_wiki_page(self, page: Dict[str, str]) -> None:
+        if page.get('html') is None:
+            # Dumps only carry wikitext, don't let tables from an older download stick around
+            if os.path.exists(f"{self.wiki_page}.html"):
+                os.remove(f"{self.wiki_page}.html")
+        else:
+            self.write_page_file("html", page['html'])
 
-    def download_wiki_wikitext(self) -> None:
-        wikitext_parse = requests.get(
-            f"https://en.wikipedia.org/w/api.php?action=parse&format=json&page={self.wiki_page}&prop=wikitext&formatversion=2",
-            headers=HEADERS).json()['parse']
+        self.write_page_file("wikitext", page['wikitext'])
+        self.write_page_file("infobox", json.dumps(wikitext_infobox_fields(page['wikitext'])))
 
-        with open(f"{self.wiki_page}.wikitext", 'w') as f:
-            f.write(wikitext_parse['wikitext'])
+    def write_page_file(self, extension: str, text: str) -> None:
+        # Written next to the real file and swapped in, so a reader sees the old contents or the new, never half
+        page_file = f"{self.wiki_page}.{extension}"
+        scratch_file = f"{page_file}.{os.getpid()}"
+        with open(scratch_file, 'w', encoding='utf-8') as f:
+            f.write(text)
 
-    def download_wiki_html(self) -> None:
-        html_parse = requests.get(
-            f"https://en.wikipedia.org/w/api.php?action=parse&format=json&page={self.wiki_page}&prop=text&formatversion=2",
-            headers=HEADERS).json()['parse']
+        os.replace(scratch_file, page_file)
 
-        with open(f"{self.wiki_page}.html", 'w', encoding='utf-8') as f:
-            f.write(html_parse['text'])
+    def page_out_of_date(self, latest_revision: Optional[PageRevision] = None) -> bool:
+        if latest_revision is None:
+            latest_revision = self.fetcher.get_latest_revision(self.wiki_page)
 
-    def update_wiki_cache(self) -> bool:
-        online_revision = self.get_online_page_revision()
+        # Revision ids tell us for sure whether anything changed, no dates to parse and compare
+        return self.get_our_page_revision_id() != latest_revision.revision_id
+
+    def update_wiki_cache(self, latest_revision: Optional[PageRevision] = None) -> bool:
+        if latest_revision is None:
+            latest_revision = self.fetcher.get_latest_revision(self.wiki_page)
 
-        if self.local_revision_out_of_date(online_revision):
-            self.download_wiki_html()
-            self.download_wiki_wikitext()
-            self.download_wiki_infobox()
-            self.last_change_date = online_revision
-            self.write_page_revision(self.last_change_date)
+        if self.page_out_of_date(latest_revision):
+            self.download_wiki_page(latest_revision.revision_id)
 
-            self.reload_spacy_docs()
+            # Recorded once its snapshot is saved, a reader going by the manifest never finds the snapshot missing
+            self.reload_spacy_docs(str(latest_revision.revision_id))
+            self.write_page_revision(latest_revision)
 
             return True
         else:
             return False
 
-    def get_body_topics(self):
+    def get_body_topics(self, body_docs: Dict[str, List[Doc]]):
         topics_dict = {}
 
-        for header, paragraphs in self.body_docs.items():
+        for header, paragraphs in body_docs.items():
             topics_list = []
 
             for paragraph in paragraphs:
@@ -174,14 +200,29 @@ class WikiDaemon:
     #        print(par)
 
     def get_tables(self, filename):
+        # The sentences below are written for Cal Poly's admissions table, a big enough table on a related article
+        # would come out as Cal Poly admissions numbers
+        if filename != WIKI_PAGE:
+            return []
+
+        # Pages ingested from a dump don't have rendered HTML to pull tables out of
+        if not os.path.exists(f"{filename}.html"):
+            return []
+
         with open(f"{filename}.html", 'r', encoding='utf-8') as f:
             html_parse = f.read()
         soup = BeautifulSoup(html_parse, 'html.parser')
         myTable = soup.find('table', {'class': "wikitable"})
+
+        if myTable is None:
+            return []
         df = pd.read_html(str(myTable))
 
         # print(df[0].values[0,1])
         years = [2018, 2017, 2016, 2015, 2014, 2013]
+        if df[0].values.shape[0] < 7 or df[0].values.shape[1] < len(years) + 1:
+            return []
+
         applicant_sen = ""
         admits_sen = ""
         perc_admit_sen = ""
@@ -208,14 +249,333 @@ class WikiDaemon:
         # print_paragraphs(paragraphs)
         return paragraphs
 
+    def reload_spacy_docs(self, revision: Optional[str] = None):
+        # Defaults to the revision the manifest has, downloads pass the one they just stored before it's recorded
+        if revision is None:
+            revision = self.get_revision_key()
+        snapshot_dir = snapshot_dir_for(self.wiki_page)
+        load_start = time.time()
+
+        knowledge = None
+        if revision is not None:
+            knowledge = load_snapshot(snapshot_dir, self.nlp, self.spacy_model, revision)
+
+            if knowledge is not None:
+                self.reload_timings = {'snapshot': time.time() - load_start}
+                METRICS.observe("polyvoice_reload_seconds", self.reload_timings['snapshot'], {"source": "snapshot"})
+                print(f"wiki_daemon: Loaded snapshot for revision {revision} in {self.reload_timings['snapshot']:.3f}s")
+
+        if knowledge is None:
+            if not self.has_local_files():
+                # Usually a title the API couldn't resolve. Leave the page out instead of taking the daemon down.
+                print(f"wiki_daemon: No local files for {self.wiki_page}, leaving it out")
+                return
+
+            # Sections that didn't change since the knowledge we're holding get carried over instead of reprocessed
+            knowledge = self.build_knowledge(revision, self.knowledge)
+
+            if revision is not None:
+                save_snapshot(knowledge, snapshot_dir, self.spacy_model)
+
+            METRICS.observe("polyvoice_reload_seconds", time.time() - load_start, {"source": "build"})
+
+        self.swap_knowledge(knowledge)
+
+    def swap_knowledge(self, knowledge: PageKnowledge):
+        # A single reference assignment, so a question sees either all of the old knowledge or all of the new
+        self.knowledge = knowledge
+
+        if self.on_swap is not None:
+            self.on_swap(self)
+
+    def load_new_revision(self, build_missing: bool = True) -> bool:
+        # Picks up a revision some other process left on disk, if it's not the one we're already holding
+        revision = self.get_revision_key()
+        if revision is None or revision == self.knowledge.revision:
+            return False
+
+        load_start = time.time()
+        knowledge = load_snapshot(snapshot_dir_for(self.wiki_page), self.nlp, self.spacy_model, revision)
+        if knowledge is None:
+            if not build_missing:
+                # Keep answering from what we have, the next reload tries again
+                print(f"wiki_daemon: No snapshot for revision {revision} of {self.wiki_page}, keeping "
+                      f"{self.knowledge.revision}")
+                return False
+
+            if not self.has_local_files():
+                print(f"wiki_daemon: No local files for revision {revision} of {self.wiki_page}, leaving it out")
+                return False
+
+            knowledge = self.build_knowledge(revision, self.knowledge)
+            METRICS.observe("polyvoice_reload_seconds", time.time() - load_start, {"source": "build"})
+        else:
+            METRICS.observe("polyvoice_reload_seconds", time.time() - load_start, {"source": "snapshot"})
+
+        print(f"wiki_daemon: Swapping in revision {revision} of {self.wiki_page}")
+        self.swap_knowledge(knowledge)
+
+        return True
+
+    def has_local_files(self) -> bool:
+        return os.path.exists(f"{self.wiki_page}.wikitext")
+
+    def build_knowledge(self, revision: Optional[str] = None, previous: Optional[PageKnowledge] = None,
+                        wikitext: Optional[str] = None) -> PageKnowledge:
+        if previous is None:
+            previous = PageKnowledge()
+
+        knowledge = PageKnowledge(revision)
+        timings = {}
+
+        stage_start = time.time()
+        # Body, lists and infobox all come out of the one wikitext, whether it's on disk or handed to us
+        if wikitext is None:
+            with open(f"{self.wiki_page}.wikitext", 'r') as f:
+                wikitext = f.read()
+
+        paragraphs = markup_paragraphs_by_title(wikitext)
+        paragraphs['Tables'] = self.get_tables(self.wiki_page)
+        infobox_strings = infobox_fields_clean(wikitext_infobox_fields(wikitext))
+
+        knowledge.section_hashes = {header: section_hash(section_paragraphs)
+                                    for header, section_paragraphs in paragraphs.items()}
+        changed_headers = [header for header, hashed in knowledge.section_hashes.items()
+                           if previous.section_hashes.get(header) != hashed]
+        changed_infobox = [section for section, value in infobox_strings.items()
+                           if section not in previous.infobox or previous.infobox[section].text != value]
+        timings['extract'] = time.time() - stage_start
+
+        # Changed body paragraphs, table paragraphs and infobox values all go through spaCy in one stream
+        stage_start = time.time()
+        body_texts = [p for header in changed_headers for p in paragraphs[header]]
+        docs = iter(parse_texts(body_texts + [infobox_strings[section] for section in changed_infobox], self.nlp,
+                                self.spacy_batch_size, self.spacy_n_process))
+        changed_docs = {header: [index_sentences(next(docs)) for _ in paragraphs[header]]
+                        for header in changed_headers}
+        knowledge.body_docs = {header: changed_docs[header] if header in changed_docs else previous.body_docs[header]
+                               for header in paragraphs}
+        changed_infobox_docs = {section: next(docs) for section in changed_infobox}
+        knowledge.infobox = {section: changed_infobox_docs.get(section, previous.infobox.get(section))
+                             for section in infobox_strings}
+        timings['spacy'] = time.time() - stage_start
+
+        stage_start = time.time()
+        changed_topics = self.get_body_topics(changed_docs)
+        knowledge.body_topics = {header: changed_topics.get(header, previous.body_topics.get(header))
+                                 for header in paragraphs}
+        timings['topics'] = time.time() - stage_start
+
+        stage_start = time.time()
+        changed_bags = wikitext_bag_by_title(changed_docs)
+        knowledge.body_bags_of_words = {header: changed_bags.get(header, previous.body_bags_of_words.get(header))
+                                        for header in paragraphs}
+        timings['bags'] = time.time() - stage_start
+
+        stage_start = time.time()
+        # Without word vectors there's nothing to embed paragraphs with, so no vectors get built or saved
+        if has_word_vectors(self.nlp):
+            changed_vectors = paragraph_vectors_by_title(changed_docs)
+            knowledge.body_vectors = {header: changed_vectors.get(header, previous.body_vectors.get(header))
+                                      for header in paragraphs}
+        timings['vectors'] = time.time() - stage_start
+
+        stage_start = time.time()
+        knowledge.lists = get_markup_lists(wikitext)
+        timings['lists'] = time.time() - stage_start
+
+        stage_start = time.time()
+        if len(changed_infobox) == 0 and set(knowledge.infobox) == set(previous.infobox) and \
+                previous.infobox_paragraph is not None:
+            knowledge.infobox_paragraph = previous.infobox_paragraph
+            knowledge.infobox_doc = previous.infobox_doc
+        else:
+            self.reload_infobox_paragraph(knowledge)
+        timings['infobox'] = time.time() - stage_start
+
+        stage_start = time.time()
+        knowledge.build_indexes(previous)
+        timings['indexes'] = time.time() - stage_start
+
+        self.reload_timings = timings
+        print(f"wiki_daemon: Reprocessed {len(changed_headers)}/{len(paragraphs)} sections and "
+              f"{len(changed_infobox)}/{len(infobox_strings)} infobox fields")
+        print("wiki_daemon: Reload stage timings " +
+              ", ".join(f"{stage}: {seconds:.3f}s" for stage, seconds in timings.items()))
+
+        return knowledge
+
+    def reload_infobox_paragraph(self, knowledge: PageKnowledge):
+        # The paragraph is written about Cal Poly, other pages' infoboxes stay out of it
+        knowledge.infobox_paragraph = wikibox_to_para(knowledge.infobox) if self.wiki_page == WIKI_PAGE else None
+
+        if knowledge.infobox_paragraph is None:
+            knowledge.infobox_doc = None
+        else:
+            knowledge.infobox_doc = index_sentences(self.nlp(knowledge.infobox_paragraph))
+
+
+class WikiDaemon:
+
+    def __init__(self, wiki_pages: Union[str, List[str]] = WIKI_PAGE, spacy_model=SPACY_MODEL,
+                 spacy_batch_size=SPACY_BATCH_SIZE, spacy_n_process=SPACY_N_PROCESS, load_transformer=True,
+                 api_url=WIKI_API_URL, concurrent_stages=CONCURRENT_STAGES, dense_retrieval=DENSE_RETRIEVAL,
+                 fallback_ranker=FALLBACK_RANKER, sentence_windows=SENTENCE_WINDOWS):
+        if isinstance(wiki_pages, str):
+            wiki_pages = [wiki_pages]
+
+        # The first page is the main one, the rest are related articles answered from alongside it
+        self.wiki_page = wiki_pages[0]
+        self.fetcher = WikiFetcher(HEADERS, api_url)
+
+        # Local revision ids for every page, checked against Wikipedia 50 titles per query
+        self.manifest = RevisionManifest()
+        self.poller = RevisionPoller(self.fetcher, self.manifest)
+
+        # NLP pipeline
+        self.nlp = get_spacy_pipeline(spacy_model)
+        self.spacy_model = spacy_model
+
+        # Pick up the WordNet traversal from the last run, if there was one
+        HYPERNYM_CACHE.load()
+
+        # Transformer pipeline. Processes that only build knowledge can skip loading it.
+        self.transformer = load_qa_model() if load_transformer else None
+
+        # Threads for the independent inquiry stages. Both sides spend most of their time in torch or numpy, which
+        # let go of the GIL, so they really do overlap. None runs everything in sequence.
+        self.stage_executor = ThreadPoolExecutor(max_workers=2) if concurrent_stages else None
+        # doc.vector on a model without word vectors is an average of its context tensors, not an embedding
+        # paragraphs can be ranked by
+        if dense_retrieval and not has_word_vectors(self.nlp):
+            print(f"wiki_daemon: {self.nlp.meta['lang']}_{self.nlp.meta['name']} has no word vectors, dense retrieval "
+                  f"stays off")
+            dense_retrieval = False
+        self.dense_retrieval = dense_retrieval
+        self.fallback_ranker = fallback_ranker
+        self.sentence_windows = sentence_windows
+
+        # One shard per page, each with its own revision tracking and indexes. They share the pipelines.
+        self.pages: Dict[str, WikiPage] = {
+            title: WikiPage(title, self.nlp, self.fetcher, self.manifest, spacy_model, spacy_batch_size,
+                            spacy_n_process, self.page_swapped)
+            for title in wiki_pages}
+
+        # Background reload that swaps in revisions the pool's refresher built while the current ones keep answering
+        self.reload_thread: Optional[threading.Thread] = None
+
+        # What inquiry reads from: every page's current knowledge plus which pages hold which terms and synsets.
+        # Rebuilt and swapped in whole whenever a page swaps in a new revision.
+        self.corpus = CorpusKnowledge({})
+        self.corpus_lock = threading.Lock()
+
+        # Answers to questions we've already seen, thrown out whenever any page revision changes
+        self.answer_cache = AnswerCache(ANSWER_CACHE_SIZE)
+
+    def page_swapped(self, swapped_page: WikiPage):
+        with self.corpus_lock:
+            if self.transformer is not None:
+                self.encode_contexts(swapped_page.knowledge, self.corpus.pages.get(swapped_page.wiki_page))
+
+            corpus = CorpusKnowledge({title: page.knowledge for title, page in self.pages.items()})
+            self.corpus = corpus
+            self.answer_cache.set_revision(corpus.revision)
+
+    def poll_revisions(self) -> Dict[str, PageRevision]:
+        # Latest revision of every page that changed since we downloaded it
+        return self.poller.poll(list(self.pages))
+
+    def update_pages(self, revisions: Dict[str, PageRevision]) -> None:
+        if len(revisions) == 0:
+            return
+
+        # Changed pages download side by side, then get reprocessed one at a time
+        download_start = time.time()
+        contents = self.fetcher.fetch_pages(list(revisions.values()))
+        METRICS.observe("polyvoice_page_download_seconds", time.time() - download_start)
+
+        for title, content in contents.items():
+            page = self.pages[title]
+            page.store_wiki_page(content)
+            # Recorded once its snapshot is saved. A builder killed in between leaves the manifest on the old
+            # revision, and the next refresh downloads this one again.
+            page.reload_spacy_docs(str(revisions[title].revision_id))
+            page.write_page_revision(revisions[title])
+
+    def encode_contexts(self, knowledge: PageKnowledge, previous: Optional[PageKnowledge] = None):
+        # Tokenize every context the QA model could be handed for this revision once, up front. Docs carried over
+        # unchanged from the previous revision are the same objects, so their encodings carry over too.
+        if len(knowledge.context_encodings) > 0:
+            return
+
+        docs = [doc for paragraphs in knowledge.body_docs.values() for doc in paragraphs]
+        if knowledge.infobox_doc is not None:
+            docs.append(knowledge.infobox_doc)
+
+        carried = {} if previous is None else previous.context_encodings
+        encodings = {id(doc): carried[id(doc)] for doc in docs if id(doc) in carried}
+        new_docs = [doc for doc in docs if id(doc) not in encodings]
+
+        for doc, encoding in zip(new_docs, self.transformer.encode_contexts([doc.text for doc in new_docs])):
+            encodings[id(doc)] = encoding
+
+        knowledge.context_encodings = encodings
+
+    def refresh_pages(self) -> Dict[str, PageRevision]:
+        revisions = self.poll_revisions()
+
+        # Changed pages start from their current snapshots, so only the sections the new revisions touched get
+        # reprocessed
+        for title in revisions:
+            page = self.pages[title]
+            if page.get_revision_key() is not None and page.knowledge.revision != page.get_revision_key():
+                page.reload_spacy_docs()
+
+        self.update_pages(revisions)
+
+        return revisions
+
+    def update_wiki_cache(self) -> bool:
+        return len(self.refresh_pages()) > 0
+
+    def load_pages(self):
+        # update_pages already reloads a page when it pulls a new revision, the rest load what's on disk
+        revisions = self.poll_revisions()
+        self.update_pages(revisions)
+
+        for title, page in self.pages.items():
+            if title not in revisions:
+                page.reload_spacy_docs()
+
     def reload_spacy_docs(self):
-        self.body_docs = wikitext_docs_by_title(f"{self.wiki_page}.wikitext", self.nlp)
-        self.body_docs['Tables'] = list(map(lambda p: self.nlp(p), self.get_tables(self.wiki_page)))
-        self.body_topics = self.get_body_topics()
-        self.body_bags_of_words = wikitext_bag_by_title(self.body_docs)
-        self.lists = get_wikitext_lists(f"{self.wiki_page}.wikitext")
-        self.infobox = wikitext_infobox_docs(f"{self.wiki_page}.infobox", self.nlp)
-        self.infobox_numbers = wikitext_infobox_numbers(self.infobox)
+        for page in self.pages.values():
+            page.reload_spacy_docs()
+
+    def load_snapshots(self, build_missing: bool = True):
+        # Serving processes leave downloading and building to prepare_page_files, they only load what it left on disk.
+        # A worker starting up with nothing to answer from builds a missing snapshot itself.
+        self.manifest.reload()
+        for title, page in self.pages.items():
+            if page.get_revision_key() is None and page.knowledge.revision is None:
+                print(f"wiki_daemon: Nothing on disk for {title} yet, answering without it")
+                continue
+
+            page.load_new_revision(build_missing)
+
+    def start_background_reload(self) -> bool:
+        if self.reload_thread is not None and self.reload_thread.is_alive():
+            return False
+
+        # Loading snapshots only, no downloading or building, so it doesn't keep inquiry off the GIL for long. A page
+        # whose snapshot isn't there keeps its current knowledge.
+        self.reload_thread = threading.Thread(target=self.load_snapshots, args=(False,), daemon=True)
+        self.reload_thread.start()
+
+        return True
+
+    @property
+    def knowledge(self) -> PageKnowledge:
+        return self.pages[self.wiki_page].knowledge
 
     def parse_infobox_question(self, question):
         doc = self.nlp(question)
@@ -267,7 +627,7 @@ class WikiDaemon:
     """
         best_section_similarity = 0
 
-        for section in self.infobox_numbers:
+        for section in self.knowledge.infobox_numbers:
             phrase_similarity = None
 
             for q_synset in [synset for synset in question_synsets if synset is not None]:
@@ -296,32 +656,31 @@ class WikiDaemon:
 
             if phrase_similarity is not None and phrase_similarity > best_section_similarity:
                 best_section_similarity = phrase_similarity
-                best_answer = self.infobox_numbers[section]
+                best_answer = self.knowledge.infobox_numbers[section]
 
         return best_answer"""
 
-    def get_weighted_wordnet_score(self, concept: Synset, topic_dict: Dict[Synset, int], distance: int = 1) -> float:
-
-        # print(f"{' ' * (distance - 1)}looking for {concept.name()}")
-        if concept in topic_dict:
-            return topic_dict[concept] / (distance * distance)
-
+    def get_weighted_wordnet_scores(self, concept: Synset, knowledge: PageKnowledge, distance: int = 1) -> np.ndarray:
+        # A paragraph's count of the concept, weighted down by how many hypernym hops up it had to be found. Falls
+        # back to the closest (lowest scoring) parent when the paragraph doesn't have it. One entry per row of
+        # topic_matrix.
+        column = knowledge.topic_columns.get(concept)
+        if column is None:
+            counts = np.zeros(len(knowledge.topic_rows))
         else:
-            parent_scores = []
-
-            parents = concept.hypernyms()
+            counts = knowledge.topic_matrix.getcol(column).toarray().ravel()
 
-            # If we get results that are too general, cut off the search so we don't get bad results
-            for parent in (parent for parent in concept.hypernyms() if parent.max_depth() > 4):
-                parent_scores.append(self.get_weighted_wordnet_score(parent, topic_dict, distance + 1))
+        # If we get results that are too general, cut off the search so we don't get bad results
+        parent_scores = [self.get_weighted_wordnet_scores(parent, knowledge, distance + 1)
+                         for parent in HYPERNYM_CACHE.hypernyms(concept) if HYPERNYM_CACHE.max_depth(parent) > 4]
 
-            # print((" " * (distance - 1)) + parent_scores.__str__())
+        if len(parent_scores) > 0:
+            fallback_scores = np.minimum.reduce(parent_scores)
+        else:
+            # If the concepts are different parts of speech this might happen
+            fallback_scores = np.zeros(len(knowledge.topic_rows))
 
-            if len(parent_scores) > 0:
-                return min(parent_scores)
-            else:
-                # If the concepts are different parts of speech this might happen
-                return 0
+        return np.where(counts > 0, counts / (distance * distance), fallback_scores)
 
     def preprocess_question_string(self, question: str) -> str:
         question = re.sub(r"calpoly", "Cal Poly", question)
@@ -333,160 +692,468 @@ class WikiDaemon:
         return question
 
     def get_sentence_from_char_idx(self, doc: Doc, char_idx) -> Optional[Span]:
-        current_location = 0
-        for sent in doc.sents:
-            for token in sent:
-                if len(token.text_with_ws) + current_location > char_idx:
-                    return sent
-                current_location += len(token.text_with_ws)
-        return None
+        # Tokens cover the doc text end to end, so the sentence holding char_idx is the last one starting at or
+        # before it
+        return sentence_from_char_idx(doc, char_idx)
+
+    def get_scoring_synsets(self, concept: Synset, scoring_synsets: Set[Synset] = None) -> Set[Synset]:
+        # Every synset get_weighted_wordnet_scores could look up for this concept
+        if scoring_synsets is None:
+            scoring_synsets = set()
+
+        scoring_synsets.add(concept)
+        for parent in HYPERNYM_CACHE.hypernyms(concept):
+            if HYPERNYM_CACHE.max_depth(parent) > 4 and parent not in scoring_synsets:
+                self.get_scoring_synsets(parent, scoring_synsets)
+
+        return scoring_synsets
+
+    def rank_paragraphs_from_synsets(self, question_synsets: List[Union[Synset, None]],
+                                     corpus: Optional[CorpusKnowledge] = None) -> List[Tuple[float, Doc]]:
+        if corpus is None:
+            corpus = self.corpus
+
+        # Only pages whose topics hold something the question's synsets could match are worth scoring
+        candidate_pages = set()
+        for q_synset in (synset for synset in question_synsets if synset is not None):
+            for synset in self.get_scoring_synsets(q_synset):
+                candidate_pages.update(corpus.synset_pages.get(synset, []))
 
-    def rank_paragraphs_from_synsets(self, question_synsets: List[Union[Synset, None]]) -> List[Tuple[float, Doc]]:
         paragraph_scores = []
+        for title in corpus.ordered(candidate_pages):
+            paragraph_scores += self.rank_page_from_synsets(question_synsets, corpus.pages[title])
+
+        return paragraph_scores
+
+    def rank_page_from_synsets(self, question_synsets: List[Union[Synset, None]],
+                               knowledge: PageKnowledge) -> List[Tuple[float, Doc]]:
+        scores = np.zeros(len(knowledge.topic_rows))
 
-        for header, paragraphs_topics in self.body_topics.items():
-            # print(header)
-            for i, paragraph_topics in enumerate(paragraphs_topics):
-                score = 0
-                for q_synset in (synset for synset in question_synsets if synset is not None):
-                    # print(f"Looking for {q_synset.name()} in {paragraph_topics}")
-                    score += self.get_weighted_wordnet_score(q_synset, paragraph_topics)
-                    # print(score)
+        # Summed in the same order as the per-paragraph loop used to, so the floats come out identical
+        for q_synset in (synset for synset in question_synsets if synset is not None):
+            scores += self.get_weighted_wordnet_scores(q_synset, knowledge)
 
-                if score > 0:
-                    paragraph_scores.append((score, self.body_docs[header][i]))
+        return [(float(scores[row]), knowledge.body_docs[header][i])
+                for row, (header, i) in enumerate(knowledge.topic_rows) if scores[row] > 0]
+
+    def rank_paragraphs_from_bag(self, question_bag_of_words: Set[str],
+                                 corpus: Optional[CorpusKnowledge] = None) -> List[Tuple[float, Doc]]:
+        if corpus is None:
+            corpus = self.corpus
+
+        candidate_pages = set()
+        for term in question_bag_of_words:
+            candidate_pages.update(corpus.term_pages.get(term, []))
+
+        paragraph_scores = []
+        for title in corpus.ordered(candidate_pages):
+            paragraph_scores += self.rank_page_from_bag(question_bag_of_words, corpus.pages[title])
 
         return paragraph_scores
 
-    def rank_paragraphs_from_bag(self, question_bag_of_words: Set[str]) -> List[Tuple[float, Doc]]:
+    def rank_page_from_bag(self, question_bag_of_words: Set[str], knowledge: PageKnowledge) \
+            -> List[Tuple[float, Doc]]:
+        # Each paragraph shows up at most once per term's posting list, so counting postings gives the same score as
+        # intersecting the bags, without touching paragraphs that share nothing with the question
+        shared_terms: Dict[Tuple[str, int], int] = {}
+
+        for term in question_bag_of_words:
+            for posting in knowledge.body_bag_index.get(term, []):
+                shared_terms[posting] = shared_terms.get(posting, 0) + 1
+
+        # Keep document order so ties sort the same way they did with the full scan
+        header_order = {header: n for n, header in enumerate(knowledge.body_bags_of_words)}
+        postings = sorted(shared_terms, key=lambda posting: (header_order[posting[0]], posting[1]))
+
+        return [(shared_terms[(header, i)], knowledge.body_docs[header][i]) for header, i in postings]
+
+    def rank_paragraphs_from_bm25(self, question_bag_of_words: Set[str],
+                                  corpus: Optional[CorpusKnowledge] = None) -> List[Tuple[float, Doc]]:
+        if corpus is None:
+            corpus = self.corpus
+
+        candidate_pages = set()
+        for term in question_bag_of_words:
+            candidate_pages.update(corpus.term_pages.get(term, []))
+
+        # Each page weighs terms by its own IDF, close enough to compare across pages for picking the top 3
         paragraph_scores = []
+        for title in corpus.ordered(candidate_pages):
+            knowledge = corpus.pages[title]
+            scores = knowledge.bm25_index.score(question_bag_of_words)
+
+            paragraph_scores += [(float(scores[row]), knowledge.body_docs[header][i])
+                                 for row, (header, i) in enumerate(knowledge.bm25_index.rows) if scores[row] > 0]
+
+        return paragraph_scores
 
-        for header, paragraph_bags in self.body_bags_of_words.items():
+    def rank_paragraphs_from_fallback(self, question_bag_of_words: Set[str],
+                                      corpus: Optional[CorpusKnowledge] = None) -> List[Tuple[float, Doc]]:
+        if self.fallback_ranker == "bm25":
+            return self.rank_paragraphs_from_bm25(question_bag_of_words, corpus)
 
-            for i, paragraph_bag in enumerate(paragraph_bags):
-                score = len(paragraph_bag & question_bag_of_words)
+        return self.rank_paragraphs_from_bag(question_bag_of_words, corpus)
 
-                if score > 0:
-                    paragraph_scores.append((score, self.body_docs[header][i]))
+    def rank_paragraphs_from_vector(self, question_vector: np.ndarray, k: int = DENSE_TOP_K,
+                                    corpus: Optional[CorpusKnowledge] = None) -> List[Tuple[float, Doc]]:
+        if corpus is None:
+            corpus = self.corpus
+
+        # Top k of every page, the caller takes the top k of those. Pages built without vectors are skipped.
+        paragraph_scores = []
+        for knowledge in corpus.pages.values():
+            if knowledge.paragraph_vectors is None or len(knowledge.paragraph_vectors) != len(knowledge.topic_rows):
+                continue
+
+            for score, row in top_k_rows(knowledge.paragraph_vectors, question_vector, k):
+                header, i = knowledge.topic_rows[row]
+                paragraph_scores.append((score, knowledge.body_docs[header][i]))
 
         return paragraph_scores
 
-    def inquiry(self, question: str) -> str:
+    def inquiry(self, question: str, trace: Optional[InquiryTrace] = None) -> str:
         # Actual call to code for processing here
+        if trace is None:
+            trace = InquiryTrace()
 
-        question = self.preprocess_question_string(question)
+        with trace.stage("preprocess"):
+            question = self.preprocess_question_string(question)
 
         print(question)
 
-        question_doc = self.nlp(question)
-        question_synsets = []
-        question_bag_of_words = set()
+        # Hold on to one revision of every page for the whole question, even if a refresh swaps in a new one
+        # meanwhile
+        corpus = self.corpus
 
-        # Detect yes/no questions
-        boolean_question = question_doc[0].pos_ == "AUX"
+        with trace.stage("cache"):
+            answer = self.answer_cache.get(question)
+        if answer is not None:
+            return trace.answer("cache", answer)
 
-        for token in question_doc:
-            if token.is_stop:
-                question_synsets.append(None)
-            else:
-                question_bag_of_words.add(token.text.lower())
+        with trace.stage("parse"):
+            question_doc = self.nlp(question)
 
-                if len(token._.wordnet.synsets()) > 0:
-                    question_synsets.append(token._.wordnet.synsets()[0])
+            # Detect yes/no questions
+            boolean_question = question_doc[0].pos_ == "AUX"
 
         # See if the question fits the format of one of the lists on the page. If not, dropout to next
-        # attempts
-        answer = try_list_question(self.lists, question_doc)
+        # attempts. These are cheap and some of them pick random items, so they don't get cached.
+        with trace.stage("list"):
+            answer = self.try_list_questions(corpus, question_doc)
         if answer is not None:
-            return answer
+            return trace.answer("list", answer)
 
-        # Run model with infobox paragraph form as context. If above threshold, that's the answer.
-        infobox_result = self.transformer.answer_question(question, wikibox_to_para(self.infobox))
-        # print(f"infobox result: answer: {infobox_result['answer']}, score: {infobox_result['score']}")
-        if infobox_result['score'] >= INFOBOX_CONF_CUTOFF:
-            return self.get_sentence_from_char_idx(self.nlp(wikibox_to_para(self.infobox)),
-                                                   infobox_result['start']).text
-            # return infobox_result['answer']
+        cache_keys = [question]
+        with trace.stage("cache"):
+            normalized_question = normalize_question(question_doc, boolean_question)
+            answer = None if normalized_question is None else self.answer_cache.get(normalized_question)
+        if answer is not None:
+            self.answer_cache.put(cache_keys, answer, corpus.revision)
+            return trace.answer("cache", answer)
 
-        paragraph_scores: List[Tuple[float, Doc]] = self.rank_paragraphs_from_synsets(question_synsets)
+        if normalized_question is not None:
+            cache_keys.append(normalized_question)
 
-        bag_of_words_fallback = False
-        # Wordnet synset matching didn't find anything, use bag of words approach
-        if len(paragraph_scores) <= 0:
-            bag_of_words_fallback = True
-            paragraph_scores = self.rank_paragraphs_from_bag(question_bag_of_words)
+        self.answer_cache.record_miss()
+        answer = self.answer_question_doc(question, question_doc, boolean_question, corpus, trace)
+        self.answer_cache.put(cache_keys, answer, corpus.revision)
 
-        if len(paragraph_scores) > 0:
-            paragraph_scores.sort(key=lambda item: item[0], reverse=True)
+        return answer
 
-            # Feed paragraphs into the neural net here
-            # print(paragraph_scores)
+    def try_list_questions(self, corpus: CorpusKnowledge, question_doc: Doc) -> Optional[str]:
+        for knowledge in corpus.pages.values():
+            try:
+                answer = try_list_question(knowledge.lists, question_doc)
+            except (KeyError, IndexError):
+                # The question matched a list this page doesn't have, or a pattern whose year it can't find
+                answer = None
 
-            # return paragraph_scores[0][1].text
-            results = list(
-                map(lambda p: (self.transformer.answer_question(question, p[1].text), p[1]), paragraph_scores[0:3]))
+            if answer is not None:
+                return answer
+
+        return None
+
+    def answer_question_doc(self, question: str, question_doc: Doc, boolean_question: bool,
+                            corpus: CorpusKnowledge, trace: Optional[InquiryTrace] = None) -> str:
+        if trace is None:
+            trace = InquiryTrace()
+
+        question_synsets = []
+        question_bag_of_words = set()
 
+        with trace.stage("parse"):
+            for token in question_doc:
+                if token.is_stop:
+                    question_synsets.append(None)
+                else:
+                    question_bag_of_words.add(token.text.lower())
+
+                    if len(token._.wordnet.synsets()) > 0:
+                        question_synsets.append(token._.wordnet.synsets()[0])
+
+            question_vector = normalized_vector(question_doc) if self.dense_retrieval else None
+
+        if self.stage_executor is not None:
+            # Retrieval and its paragraph QA don't depend on the infobox pass, so both start right away. The infobox
+            # still gets the first say, the paragraph side is only waited on if it comes up short.
+            # The paragraph side can outlive the question, so it gets a trace of its own. The caller may already be
+            # reading ours.
+            paragraph_trace = InquiryTrace()
+            paragraphs_cancelled = threading.Event()
+            infobox_future = self.stage_executor.submit(self.answer_from_infobox, question, question_bag_of_words,
+                                                        corpus, trace)
+            paragraph_future = self.stage_executor.submit(self.answer_from_paragraphs, question, question_synsets,
+                                                          question_bag_of_words, corpus, paragraph_trace,
+                                                          question_vector, paragraphs_cancelled)
+
+            answer = infobox_future.result()
+            if answer is not None:
+                # Whatever the paragraph side comes up with doesn't matter anymore. If it's already running, it stops
+                # before the transformer so the thread is free for the next question.
+                paragraphs_cancelled.set()
+                paragraph_future.cancel()
+                return trace.answer("infobox_qa", answer)
+
+            results, bag_of_words_fallback = paragraph_future.result()
+            trace.merge(paragraph_trace)
+        else:
+            answer = self.answer_from_infobox(question, question_bag_of_words, corpus, trace)
+            if answer is not None:
+                return trace.answer("infobox_qa", answer)
+
+            results, bag_of_words_fallback = self.answer_from_paragraphs(question, question_synsets,
+                                                                         question_bag_of_words, corpus, trace,
+                                                                         question_vector)
+
+        if len(results) > 0:
             best_answer = None
             best_answer_score = 0
             for result, paragraph in results:
                 print(f"({result['answer']}): {result['score']}")
                 if result['score'] > best_answer_score:
                     best_answer_score = result['score']
-                    best_answer = self.get_sentence_from_char_idx(paragraph, result['start']).text
+                    with trace.stage("sentence"):
+                        best_answer = self.get_sentence_from_char_idx(paragraph, result['start']).text
+
+            if question_vector is not None:
+                ranking_stage = "dense_rank"
+            else:
+                ranking_stage = "bag_fallback" if bag_of_words_fallback else "synset_rank"
 
             if boolean_question:
-                return "Yes" if best_answer_score > BOOLEAN_ANSWER_CONF_THRESH else "No"
+                return trace.answer(ranking_stage, "Yes" if best_answer_score > BOOLEAN_ANSWER_CONF_THRESH else "No")
 
             elif best_answer_score > ANSWER_CONF_CUTOFF or (
                     bag_of_words_fallback and best_answer_score > BAG_OF_WORDS_CONF_CUTOFF):
-                return best_answer
+                return trace.answer(ranking_stage, best_answer)
 
         # None of our cases figured out an answer
-        return "Sorry, not sure about that one."
+        return trace.answer("none", NO_ANSWER)
+
+    def narrow_context(self, doc: Doc, question_bag_of_words: Set[str], corpus: CorpusKnowledge) -> Tuple[str, int]:
+        # The best matching sentence plus SENTENCE_WINDOW_RADIUS either side, and where that window starts in the doc.
+        # Whole sentences only, so an answer inside it lands in the same sentence of the full doc.
+        bags = corpus.sentence_bags.get(id(doc))
+        if not self.sentence_windows or bags is None or len(bags) <= 2 * SENTENCE_WINDOW_RADIUS + 1:
+            return doc.text, 0
+
+        shared = [len(bag & question_bag_of_words) for bag in bags]
+        best = shared.index(max(shared))
+        # Nothing to go on, let the transformer see all of it
+        if shared[best] == 0:
+            return doc.text, 0
+
+        first, last = max(0, best - SENTENCE_WINDOW_RADIUS), min(len(bags), best + SENTENCE_WINDOW_RADIUS + 1)
+        start = doc._.sent_char_starts[first]
+        end = doc._.sent_char_starts[last] if last < len(bags) else len(doc.text)
+
+        return doc.text[start:end], start
+
+    def answer_docs(self, question: str, docs: List[Doc], cutoff: float, question_bag_of_words: Set[str],
+                    corpus: CorpusKnowledge) -> List[Dict]:
+        # QA over each doc, or over its sentence window, with answer offsets always relative to the whole doc
+        contexts = [self.narrow_context(doc, question_bag_of_words, corpus) for doc in docs]
+        # Narrowed windows aren't in the tokenized context cache, they get tokenized on the spot
+        encodings = [corpus.context_encodings.get(id(doc)) if offset == 0 and text == doc.text else None
+                     for doc, (text, offset) in zip(docs, contexts)]
+
+        results = self.transformer.answer_questions(question, [text for text, _ in contexts], cutoff, encodings)
+
+        return [dict(result, start=result['start'] + offset, end=result['end'] + offset)
+                for result, (_, offset) in zip(results, contexts)]
+
+    def answer_from_infobox(self, question: str, question_bag_of_words: Set[str], corpus: CorpusKnowledge,
+                            trace: InquiryTrace) -> Optional[str]:
+        # Run model with infobox paragraph form as context. If above threshold, that's the answer.
+        infobox_pages = [knowledge for knowledge in corpus.pages.values() if knowledge.infobox_paragraph is not None]
+        if len(infobox_pages) == 0:
+            return None
+
+        with trace.stage("infobox_qa"):
+            infobox_results = self.answer_docs(question, [knowledge.infobox_doc for knowledge in infobox_pages],
+                                               INFOBOX_CONF_CUTOFF, question_bag_of_words, corpus)
+            infobox_result, knowledge = max(zip(infobox_results, infobox_pages), key=lambda item: item[0]['score'])
+        # print(f"infobox result: answer: {infobox_result['answer']}, score: {infobox_result['score']}")
+        if infobox_result['score'] >= INFOBOX_CONF_CUTOFF:
+            with trace.stage("sentence"):
+                return self.get_sentence_from_char_idx(knowledge.infobox_doc, infobox_result['start']).text
+            # return infobox_result['answer']
+
+        return None
+
+    def answer_from_paragraphs(self, question: str, question_synsets: List[Union[Synset, None]],
+                               question_bag_of_words: Set[str], corpus: CorpusKnowledge, trace: InquiryTrace,
+                               question_vector: Optional[np.ndarray] = None,
+                               cancelled: Optional[threading.Event] = None) -> Tuple[List[Tuple[Dict, Doc]], bool]:
+        bag_of_words_fallback = False
+
+        if question_vector is not None:
+            top_k = DENSE_TOP_K
+            with trace.stage("dense_rank"):
+                paragraph_scores = self.rank_paragraphs_from_vector(question_vector, top_k, corpus)
+        else:
+            top_k = 3
+            with trace.stage("synset_rank"):
+                paragraph_scores: List[Tuple[float, Doc]] = self.rank_paragraphs_from_synsets(question_synsets,
+                                                                                              corpus)
+
+            # Wordnet synset matching didn't find anything, use bag of words approach
+            if len(paragraph_scores) <= 0:
+                bag_of_words_fallback = True
+                with trace.stage("bag_fallback"):
+                    paragraph_scores = self.rank_paragraphs_from_fallback(question_bag_of_words, corpus)
+
+        # The infobox answered while we were ranking, the transformer pass would go to waste
+        if len(paragraph_scores) == 0 or (cancelled is not None and cancelled.is_set()):
+            return [], bag_of_words_fallback
+
+        with trace.stage("transformer"):
+            # Merged top k across every page. nlargest keeps ties in page and document order, same as a stable sort.
+            paragraph_scores = heapq.nlargest(top_k, paragraph_scores, key=lambda item: item[0])
+
+            # Feed paragraphs into the neural net here
+            # print(paragraph_scores)
+
+            # return paragraph_scores[0][1].text
+            top_paragraphs = [paragraph for _, paragraph in paragraph_scores]
+            results = list(zip(self.answer_docs(question, top_paragraphs, PARAGRAPH_QA_CUTOFF, question_bag_of_words,
+                                                corpus), top_paragraphs))
+
+        return results, bag_of_words_fallback
+
+    def record_inquiry(self, trace: InquiryTrace, seconds: float) -> None:
+        METRICS.inc("polyvoice_inquiries_total")
+        METRICS.inc("polyvoice_inquiry_answers_total", {"stage": str(trace.answered_by)})
+        METRICS.observe("polyvoice_inquiry_seconds", seconds)
+
+        for stage, stage_seconds in trace.timings.items():
+            METRICS.observe("polyvoice_inquiry_stage_seconds", stage_seconds, {"stage": stage})
+
+    def metrics_snapshot(self) -> MetricsRegistry:
+        # Point in time values get filled in when somebody asks, the rest is recorded as it happens
+        worker = {"worker": str(os.getpid())}
+        for name, value in self.answer_cache.stats().items():
+            METRICS.set_gauge(f"polyvoice_answer_cache_{name}", value, worker)
+        if self.transformer is not None:
+            for name, value in self.transformer.stats().items():
+                METRICS.set_gauge(f"polyvoice_qa_{name}", value, worker)
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for title, page in self.pages.items():
+            timestamp = self.manifest.get_timestamp(title)
+            if timestamp is not None and page.knowledge.revision == page.get_revision_key():
+                revision_date = datetime.datetime.strptime(timestamp, WIKI_TIMESTAMP_FORMAT) \
+                    .replace(tzinfo=datetime.timezone.utc)
+                METRICS.set_gauge("polyvoice_revision_age_seconds", (now - revision_date).total_seconds(),
+                                  {"page": title})
+
+        return METRICS.snapshot()
 
     def get_paragraph_names(self):
-        return list(self.body_docs.keys())
+        return [header for knowledge in self.corpus.pages.values() for header in knowledge.body_docs]
 
 
-def run_daemon(qa_pipe: Connection):
-    wiki_daemon = WikiDaemon(WIKI_PAGE)
-    wiki_daemon.update_wiki_cache()
-    wiki_daemon.reload_spacy_docs()
-    print("wiki_daemon: Child process started")
-    next_wiki_update = time.time() + UPDATE_PERIOD_SECS
-    while True:
-        now = time.time()
-        if next_wiki_update < now:
-            print("wiki_daemon: Checking Wikipedia for updates")
-            updated = wiki_daemon.update_wiki_cache()
+def prepare_page_files(wiki_pages: List[str] = WIKI_PAGES, spacy_model: str = SPACY_MODEL,
+                       api_url: str = WIKI_API_URL):
+    # Brings every page's files and snapshot up to date before any worker starts loading them
+    wiki_daemon = WikiDaemon(wiki_pages, spacy_model, load_transformer=False, api_url=api_url)
+    wiki_daemon.load_pages()
+
+    # Once per run instead of once per page, it's the whole cache every time
+    HYPERNYM_CACHE.save()
+
+
+def refresh_page_files(wiki_pages: List[str] = WIKI_PAGES, spacy_model: str = SPACY_MODEL,
+                       api_url: str = WIKI_API_URL):
+    # Leaves changed pages' new files and snapshots on disk for the workers to reload
+    wiki_daemon = WikiDaemon(wiki_pages, spacy_model, load_transformer=False, api_url=api_url)
+
+    revisions = wiki_daemon.refresh_pages()
+    for title, revision in revisions.items():
+        print(f"wiki_daemon: Built revision {revision.revision_id} of {title}")
+
+    if len(revisions) > 0:
+        HYPERNYM_CACHE.save()
 
-            if updated:
-                print("wiki_daemon: Got new revision, updating")
 
-            next_wiki_update = now + UPDATE_PERIOD_SECS
+def run_daemon(qa_pipe: Connection, qa_threads: Optional[int] = None):
+    # Has to happen before the QA model loads
+    if qa_threads is not None:
+        set_qa_threads(qa_threads)
 
-        if qa_pipe.poll(timeout=next_wiki_update - now):
+    wiki_daemon = WikiDaemon(WIKI_PAGES)
+    wiki_daemon.load_snapshots()
+    print("wiki_daemon: Child process started")
+    while True:
+        # Messages are (request id, kind, payload, time sent) so the pool can pair answers back up with the
+        # right caller
+        request_id = None
+        try:
+            request_id, kind, payload, sent_at = qa_pipe.recv()
+            METRICS.observe("polyvoice_pipe_queue_wait_seconds", max(0.0, time.time() - sent_at))
+
+            if kind == METRICS_MESSAGE:
+                qa_pipe.send((request_id, wiki_daemon.metrics_snapshot()))
+            elif kind == RELOAD_MESSAGE:
+                # The pool's refresher left new revisions on disk. They get swapped in by themselves once loaded,
+                # questions keep being answered meanwhile.
+                print(f"wiki_daemon: Answer cache {wiki_daemon.answer_cache.stats()}")
+                qa_pipe.send((request_id, wiki_daemon.start_background_reload()))
+            else:
+                trace = InquiryTrace()
+                inquiry_start = time.perf_counter()
+                answer = wiki_daemon.inquiry(payload, trace)
+                wiki_daemon.record_inquiry(trace, time.perf_counter() - inquiry_start)
+
+                qa_pipe.send((request_id, answer))
+        except EOFError:
+            # Pipe was closed on other end, we're done here
+            qa_pipe.close()
+            return
+        except ValueError:
+            print("Answer was too large to send!")
+
+            # Make sure the caller isn't still waiting for an object
             try:
-                question = qa_pipe.recv()
-                qa_pipe.send(wiki_daemon.inquiry(question))
+                qa_pipe.send((request_id, ""))
             except EOFError:
-                # Pipe was closed on other end, we're done here
                 qa_pipe.close()
                 return
-            except ValueError:
-                print("Answer was too large to send!")
+        except Exception:
+            # One bad question shouldn't take the worker down with it, the pool would be a worker short
+            print(f"wiki_daemon: Request {request_id} failed")
+            traceback.print_exc()
 
-                # Make sure the caller isn't still waiting for an object
-                try:
-                    qa_pipe.send("")
-                except EOFError:
-                    qa_pipe.close()
-                    return
+            try:
+                qa_pipe.send((request_id, NO_ANSWER))
+            except (EOFError, OSError):
+                qa_pipe.close()
+                return
 
 
 def test_question(questions):
     init_start_time = time.time()
-    wiki_daemon = WikiDaemon(WIKI_PAGE)
+    wiki_daemon = WikiDaemon(WIKI_PAGES)
     init_end_time = time.time()
     print(f"Pipeline init took {init_end_time - init_start_time} seconds")
 
@@ -503,6 +1170,9 @@ def test_question(questions):
 
         print(answer)
 
+    print(f"Answer cache: {wiki_daemon.answer_cache.stats()}")
+    print(f"QA model: {wiki_daemon.transformer.stats()}")
+
 
 # In case you want to test one-off questions
 if __name__ == "__main__":
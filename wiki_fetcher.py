@@ -0,0 +1,92 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Point this at a local stub to run the download layer offline
+WIKI_API_URL = os.environ.get("POLYVOICE_WIKI_API", "https://en.wikipedia.org/w/api.php")
+FETCH_POOL_SIZE = 4
+FETCH_RETRIES = 2
+FETCH_TIMEOUT_SECS = 30
+# Most titles the API takes in one query for a normal (non-bot) client
+MAX_TITLES_PER_QUERY = 50
+
+
+class PageRevision:
+
+    def __init__(self, title: str, revision_id: int, timestamp: str):
+        self.title = title
+        self.revision_id = revision_id
+        self.timestamp = timestamp
+
+
+class WikiFetcher:
+
+    def __init__(self, headers: Dict[str, str], api_url: str = WIKI_API_URL, pool_size: int = FETCH_POOL_SIZE):
+        self.api_url = api_url
+        self.pool_size = pool_size
+
+        # One session for everything, so connections get kept alive and reused between calls
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=FETCH_RETRIES)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def api_get(self, params: Dict[str, str]) -> Dict:
+        params = dict(params, format="json", formatversion="2")
+        response = self.session.get(self.api_url, params=params, timeout=FETCH_TIMEOUT_SECS)
+        response.raise_for_status()
+
+        return response.json()
+
+    def get_latest_revision(self, title: str) -> Optional[PageRevision]:
+        return self.get_latest_revisions([title]).get(title)
+
+    def get_latest_revisions(self, titles: List[str]) -> Dict[str, PageRevision]:
+        revisions = {}
+
+        for batch_start in range(0, len(titles), MAX_TITLES_PER_QUERY):
+            batch = titles[batch_start:batch_start + MAX_TITLES_PER_QUERY]
+            query = self.api_get({
+                "action": "query",
+                "prop": "revisions",
+                "rvprop": "ids|timestamp",
+                "titles": "|".join(batch),
+                "redirects": "1"
+            })['query']
+
+            # The API answers under the normalized, redirected title, so follow that back to the title we asked for
+            resolved = {title: title for title in batch}
+            for step in query.get('normalized', []) + query.get('redirects', []):
+                for title, current in resolved.items():
+                    if current == step['from']:
+                        resolved[title] = step['to']
+
+            latest = {page['title']: page['revisions'][0] for page in query['pages'] if 'revisions' in page}
+            for title, current in resolved.items():
+                if current in latest:
+                    revisions[title] = PageRevision(title, latest[current]['revid'], latest[current]['timestamp'])
+
+        return revisions
+
+    def fetch_page(self, title: str, revision_id: Optional[int] = None) -> Dict[str, str]:
+        # HTML and wikitext come back from the same parse, pinned to the revision we checked if we have one
+        params = {"action": "parse", "prop": "text|wikitext|revid"}
+        if revision_id is not None:
+            params["oldid"] = str(revision_id)
+        else:
+            params["page"] = title
+            params["redirects"] = "1"
+
+        parse = self.api_get(params)['parse']
+
+        return {"revid": parse['revid'], "html": parse['text'], "wikitext": parse['wikitext']}
+
+    def fetch_pages(self, revisions: List[PageRevision]) -> Dict[str, Dict[str, str]]:
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            pages = executor.map(lambda revision: self.fetch_page(revision.title, revision.revision_id), revisions)
+
+            return {revision.title: page for revision, page in zip(revisions, pages)}